@@ -0,0 +1,207 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+import threading
+from collections import OrderedDict
+
+class CppScopeIndex:
+    # functions and classes of a C/C++ source found by a lightweight brace scanner.
+    # comments, string/char literals and preprocessor lines are skipped. scopes are (kind, start_index, end_index) of the lines
+    KIND_FUNCTION = "function"
+    KIND_CLASS = "class"
+    KIND_BLOCK = "block"
+    KIND_INITIALIZER = "initializer"
+
+    CLASS_KEYWORD = re.compile(r'\b(?:class|struct|union)\b')
+    INITIALIZER_LIST = re.compile(r'\)\s*:(?!:).*[\w>]$')
+    CONTROL_HEADER = re.compile(r'^(?:if|for|while|switch|catch|do|else|try|namespace|extern|enum)\b')
+    TOKEN = re.compile(r'\w+|[^\w\s]')
+    ACCESS_SPECIFIERS = ("public:", "protected:", "private:")
+    SPECIAL = re.compile(r'//|/\*|["\'{};]')
+
+    def __init__(self, lines):
+        self.scopes = []
+        self.token_offsets = [0]
+        for line in lines:
+            self.token_offsets.append( self.token_offsets[-1] + self.estimate_tokens(line) )
+        self.scan(lines)
+
+    @staticmethod
+    def estimate_tokens(text):
+        # BPE-like estimate : a token per punctuation and per 4 chars of a word
+        tokens = 0
+        for token in CppScopeIndex.TOKEN.findall(text):
+            tokens += (len(token)+3)//4
+        return tokens + 1
+
+    def get_tokens(self, start_index, end_index):
+        # estimated tokens of lines[start_index:end_index]
+        return self.token_offsets[end_index] - self.token_offsets[start_index]
+
+    def classify(self, header):
+        header = " ".join(header.split())
+        if not header or header.endswith(("=", "(", ",", "return")):
+            return self.KIND_BLOCK
+        if self.CONTROL_HEADER.match(header):
+            return self.KIND_BLOCK
+        class_keyword = None
+        for class_keyword in self.CLASS_KEYWORD.finditer(header):
+            pass
+        if class_keyword and not "(" in header[class_keyword.end():]:
+            return self.KIND_CLASS
+        if self.INITIALIZER_LIST.search(header):
+            # brace initializer in the constructor's initializer list e.g. A() : x{1} {
+            return self.KIND_INITIALIZER
+        if ")" in header:
+            return self.KIND_FUNCTION
+        return self.KIND_BLOCK
+
+    def scan(self, lines):
+        stack = []
+        header = []
+        header_start = None
+        in_block_comment = False
+        in_preprocessor = False
+        for index, line in enumerate(lines):
+            if in_preprocessor or (not in_block_comment and line.lstrip().startswith("#")):
+                in_preprocessor = line.rstrip().endswith("\\")
+                continue
+            i = 0
+            length = len(line)
+            while i < length:
+                if in_block_comment:
+                    end = line.find("*/", i)
+                    if end == -1:
+                        break
+                    in_block_comment = False
+                    i = end + 2
+                    continue
+                # the text between the special tokens is a part of the header
+                m = self.SPECIAL.search(line, i)
+                text = line[i:m.start()] if m else line[i:]
+                if text:
+                    if header_start == None and not text.isspace():
+                        header_start = index
+                    header.append(text)
+                if not m:
+                    break
+                token = m.group()
+                i = m.end()
+                if token == "//":
+                    break
+                elif token == "/*":
+                    in_block_comment = True
+                elif token == '"' or token == "'":
+                    if token == "'" and m.start()>0 and line[m.start()-1].isalnum():
+                        # digit separator e.g. 1'000
+                        continue
+                    # skip the literal
+                    while i < length and line[i] != token:
+                        i += 2 if line[i] == "\\" else 1
+                    i += 1
+                    header.append(token+token)
+                elif token == "{":
+                    stack.append( (self.classify("".join(header)), header_start if header_start!=None else index, header) )
+                    header = []
+                    header_start = None
+                elif token == "}":
+                    header = []
+                    header_start = None
+                    if stack:
+                        kind, start_index, saved_header = stack.pop()
+                        if kind == self.KIND_INITIALIZER:
+                            # the header of the constructor continues
+                            header = saved_header + ["{}"]
+                            header_start = start_index
+                        elif kind != self.KIND_BLOCK:
+                            self.scopes.append( (kind, start_index, index) )
+                else:
+                    # ;
+                    header = []
+                    header_start = None
+            if not line.strip() or (len(header) < 4 and "".join(header).strip() in self.ACCESS_SPECIFIERS):
+                # a declaration doesn't continue over the empty line
+                header = []
+                header_start = None
+            header.append(" ")
+
+    def find_scope(self, index):
+        # the outermost function (lambdas and local classes are in it) or the innermost class which contains the index
+        function = None
+        class_scope = None
+        for kind, start_index, end_index in self.scopes:
+            if start_index <= index <= end_index:
+                if kind == self.KIND_FUNCTION:
+                    if function == None or start_index < function[1]:
+                        function = (kind, start_index, end_index)
+                elif class_scope == None or start_index > class_scope[1]:
+                    class_scope = (kind, start_index, end_index)
+        return function if function else class_scope
+
+
+class CodeContextExtractor:
+    # window of the finding : the enclosing function or class trimmed to the token budget. the scope indexes are cached per file
+    DEFAULT_TOKEN_BUDGET = 1024
+    MAX_CACHED_FILES = 64
+
+    def __init__(self, token_budget=None, margin_lines=10):
+        self.token_budget = token_budget if token_budget else self.DEFAULT_TOKEN_BUDGET
+        self.margin_lines = margin_lines
+        self.lock = threading.Lock()
+        self.indexes = OrderedDict()
+
+    def get_scope_index(self, lines):
+        # keyed by the lines object. the entry holds it so that the id isn't reused while it's cached
+        key = id(lines)
+        with self.lock:
+            entry = self.indexes.get(key)
+            if entry and entry[0] is lines:
+                self.indexes.move_to_end(key)
+                return entry[1]
+        index = CppScopeIndex(lines)
+        with self.lock:
+            self.indexes[key] = (lines, index)
+            while len(self.indexes) > self.MAX_CACHED_FILES:
+                self.indexes.popitem(last=False)
+        return index
+
+    def trim(self, index, target_index, start_index, end_index):
+        # grows [start, end) from the target line alternately until the token budget is reached
+        start = target_index
+        end = min(target_index+1, end_index)
+        while True:
+            is_grown = False
+            if start > start_index and index.get_tokens(start-1, end) <= self.token_budget:
+                start -= 1
+                is_grown = True
+            if end < end_index and index.get_tokens(start, end+1) <= self.token_budget:
+                end += 1
+                is_grown = True
+            if not is_grown:
+                break
+        return start, end
+
+    def get_window(self, lines, target_index):
+        # returns [start, end) of the lines for the finding at lines[target_index]
+        index = self.get_scope_index(lines)
+        target_index = max(min(target_index, len(lines)-1), 0)
+        scope = index.find_scope(target_index)
+        if scope:
+            start_index, end_index = scope[1], scope[2]+1
+        else:
+            start_index, end_index = max(target_index-self.margin_lines, 0), min(target_index+self.margin_lines, len(lines))
+        if index.get_tokens(start_index, end_index) > self.token_budget:
+            start_index, end_index = self.trim(index, target_index, start_index, end_index)
+        return start_index, end_index
@@ -0,0 +1,238 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+
+class LocalResolverRegistry:
+    # deterministic fixes keyed by cppcheck message id.
+    # a rule is rule(lines, target_index, message) and returns the fixed lines or None if it doesn't match
+    def __init__(self):
+        self.rules = {}
+
+    def register(self, message_id, rule):
+        self.rules[message_id] = rule
+
+    def has_rule(self, message_id):
+        return message_id in self.rules
+
+    def resolve(self, target_lines, relative_pos, messages):
+        # relative_pos is the line number (1-based) of the reported line in target_lines
+        # messages : {message_id: [messages]}. returns the resolved code or None if any of the messages isn't handled
+        if not messages or not all(self.has_rule(message_id) for message_id in messages.keys()):
+            return None
+        lines = target_lines.splitlines() if isinstance(target_lines, str) else list(target_lines)
+        for message_id, _messages in messages.items():
+            for message in _messages:
+                lines = self.rules[message_id](lines, relative_pos-1, message)
+                if lines==None:
+                    return None
+        return "```\n" + "\n".join(lines) + "\n```"
+
+
+class CppCheckRules:
+    NAME_IN_QUOTE = re.compile(r"'([^']+)'")
+
+    @staticmethod
+    def get_name(message, index=0):
+        names = CppCheckRules.NAME_IN_QUOTE.findall(message)
+        return names[index] if len(names)>index else None
+
+    @staticmethod
+    def iter_near_lines(lines, target_index, margin=1):
+        # the reported line first, then the neighbors
+        for delta in [0] + [d for i in range(1, margin+1) for d in (-i, i)]:
+            i = target_index + delta
+            if i>=0 and i<len(lines):
+                yield i
+
+    @staticmethod
+    def replace_line(lines, target_index, pattern, replacement, margin=1):
+        for i in CppCheckRules.iter_near_lines(lines, target_index, margin):
+            new_line, count = pattern.subn(replacement, lines[i], 1)
+            if count:
+                lines = list(lines)
+                lines[i] = new_line
+                return lines
+        return None
+
+    TYPE = r'[\w:]+(?:\s*<[^()]*?>)?'
+
+    @staticmethod
+    def passed_by_value(lines, target_index, message):
+        # Function parameter 's' should be passed by const reference.
+        name = CppCheckRules.get_name(message)
+        if not name:
+            return None
+        pattern = re.compile(r'(?<![\w&*])(const\s+)?(' + CppCheckRules.TYPE + r')\s+(' + re.escape(name) + r')\b(?=\s*[,)=])')
+        return CppCheckRules.replace_line(lines, target_index, pattern, r'const \2& \3')
+
+    @staticmethod
+    def const_parameter(lines, target_index, message):
+        # Parameter 'p' can be declared as pointer to const / reference to const
+        name = CppCheckRules.get_name(message)
+        if not name:
+            return None
+        pattern = re.compile(r'(?<![\w])(?<!const )(' + CppCheckRules.TYPE + r')(\s*[*&]\s*)(' + re.escape(name) + r')\b(?=\s*[,)=])')
+        return CppCheckRules.replace_line(lines, target_index, pattern, r'const \1\2\3')
+
+    @staticmethod
+    def missing_override(lines, target_index, message):
+        # The function 'f' overrides a function in a base class but is not marked with a 'override' specifier.
+        name = CppCheckRules.get_name(message)
+        if not name:
+            return None
+        pattern = re.compile(r'\b' + re.escape(name) + r'\s*\(')
+        for i in CppCheckRules.iter_near_lines(lines, target_index):
+            line = lines[i]
+            m = pattern.search(line)
+            if not m or "override" in line:
+                continue
+            # the closing parenthesis of the parameter list
+            depth = 0
+            pos = m.end()-1
+            while pos<len(line):
+                if line[pos]=="(":
+                    depth += 1
+                elif line[pos]==")":
+                    depth -= 1
+                    if depth==0:
+                        break
+                pos += 1
+            if depth:
+                return None
+            pos += 1
+            qualifiers = re.match(r'(\s*(?:const|noexcept(?:\([^)]*\))?|&&|&|volatile)\b)*', line[pos:])
+            pos += qualifiers.end()
+            rest = line[pos:]
+            if rest.strip()=="" or rest.lstrip().startswith((";", "{", "=")):
+                lines = list(lines)
+                lines[i] = re.sub(r'^(\s*)virtual\s+', r'\1', line[:pos]) + " override" + rest
+                return lines
+        return None
+
+    @staticmethod
+    def iter_class_body_lines(lines, class_name):
+        # indexes of the lines directly in the body of the class e.g. the member declarations. nothing if the class head isn't in the lines
+        head = re.compile(r'\b(?:class|struct)\s+(?:\w+\s+)*' + re.escape(class_name) + r'\b')
+        depth = None
+        for i, line in enumerate(lines):
+            code = line.split("//")[0]
+            if depth==None:
+                if not head.search(code) or code.rstrip().endswith(";"):
+                    continue
+                depth = 0
+            elif depth==1:
+                yield i
+            for c in code:
+                if c=="{":
+                    depth += 1
+                elif c=="}":
+                    depth -= 1
+                    if depth<=0:
+                        return
+
+    @staticmethod
+    def uninit_member_var(lines, target_index, message):
+        # Member variable 'Class::x' is not initialized in the constructor.
+        name = CppCheckRules.get_name(message)
+        if not name or not "::" in name:
+            return None
+        class_name, name = name.split("::")[-2:]
+        pattern = re.compile(r'^(\s*(?:mutable\s+)?' + CppCheckRules.TYPE + r'[\s*&]+' + re.escape(name) + r')\s*;')
+        for i in CppCheckRules.iter_class_body_lines(lines, class_name):
+            line = lines[i]
+            if pattern.search(line):
+                lines = list(lines)
+                lines[i] = pattern.sub(r'\1{};', line, 1)
+                return lines
+        return None
+
+    # Class::Class( or Class( without the return type e.g. in the class body
+    CONSTRUCTOR = re.compile(r'^\s*(?:template\s*<.*>\s*)?(?:(?:explicit|inline|constexpr)\s+)*(?:\w+(?:\s*<[^()]*?>)?::)*?(?:(\w+)(?:\s*<[^()]*?>)?::)?(\w+)\s*\(')
+    KEYWORDS = {"if", "for", "while", "switch", "catch", "return", "sizeof", "decltype", "alignof", "static_assert"}
+
+    @staticmethod
+    def is_constructor_header(lines, header_index):
+        # the header may be the initializer list continued from the constructor line above
+        for i in range(header_index, -1, -1):
+            line = lines[i].split("//")[0].strip()
+            if line=="":
+                continue
+            if line.startswith(":") or line.startswith(","):
+                continue
+            m = CppCheckRules.CONSTRUCTOR.match(line)
+            if not m or m.group(2) in CppCheckRules.KEYWORDS:
+                return False
+            if m.group(1)!=None:
+                return m.group(1)==m.group(2)
+            # Class( needs the class head in the lines. otherwise it can't be told from e.g. a macro
+            return i in CppCheckRules.iter_class_body_lines(lines, m.group(2))
+        return False
+
+    @staticmethod
+    def use_initialization_list(lines, target_index, message):
+        # Variable 'x' is assigned in constructor body. Consider performing initialization in initialization list.
+        name = CppCheckRules.get_name(message)
+        if not name:
+            return None
+        assign = re.compile(r'^\s*(?:this->)?' + re.escape(name) + r'\s*=\s*(.+?);\s*$')
+        for i in CppCheckRules.iter_near_lines(lines, target_index):
+            m = assign.match(lines[i])
+            if not m:
+                continue
+            # the constructor's opening brace must be the nearest one above with nothing else in the body
+            for j in range(i-1, -1, -1):
+                line = lines[j]
+                if line.strip()=="" or assign.match(line):
+                    continue
+                if not line.rstrip().endswith("{") or line.count("{")!=1:
+                    return None
+                header = line.rstrip()[:-1].rstrip()
+                header_index = j
+                if header=="":
+                    # brace on its own line
+                    header_index = j-1
+                    if header_index<0:
+                        return None
+                    header = lines[header_index].rstrip()
+                if not header.endswith(")") and ":" not in header:
+                    return None
+                if not CppCheckRules.is_constructor_header(lines, header_index):
+                    # e.g. the block of if/for/while or a member function
+                    return None
+                initializer = f"{name}({m.group(1).strip()})"
+                if re.search(r'\)\s*:\s*\w', header) or header.lstrip().startswith((":", ",")):
+                    header += f", {initializer}"
+                else:
+                    header += f" : {initializer}"
+                lines = list(lines)
+                if header_index==j:
+                    lines[j] = header + " {"
+                else:
+                    lines[header_index] = header
+                del lines[i]
+                return lines
+        return None
+
+    @staticmethod
+    def new_registry():
+        registry = LocalResolverRegistry()
+        registry.register("passedByValue", CppCheckRules.passed_by_value)
+        registry.register("constParameter", CppCheckRules.const_parameter)
+        registry.register("constParameterPointer", CppCheckRules.const_parameter)
+        registry.register("constParameterReference", CppCheckRules.const_parameter)
+        registry.register("missingOverride", CppCheckRules.missing_override)
+        registry.register("uninitMemberVar", CppCheckRules.uninit_member_var)
+        registry.register("useInitializationList", CppCheckRules.use_initialization_list)
+        return registry
@@ -17,9 +17,31 @@ import os
 import sys
 import json
 import select
-from GptHelper import GptClientFactory, IGpt, GptQueryWithCheck
+import signal
+import re
+import hashlib
+import subprocess
+import shlex
+import threading
+import time
+import io
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from GptHelper import GptClientFactory, IGpt, GptQueryWithCheck, RateController, StreamStopCondition
 from ExecUtil import ExecUtil
 from JsonCache import JsonCache
+from DiffUtil import DiffUtil
+from CppCheckRules import CppCheckRules
+from SimilarityIndex import SimilarityIndex
+from CodeContext import CodeContextExtractor
+from SourceFileIndex import SourceFileIndex
+from DirectoryTreeIndex import DirectoryTreeIndex
+from FindingStore import FindingStore
+from GitUtil import GitIncrementalFilter
+from OfflineBatch import OfflineBatchWriter, OfflineBatchReader
+from RunJournal import RunJournal, JournaledTargetReader, JournalOutput
+from ResolverDaemon import ResolverServer, ResolverClient
 
 
 class MarkdownTableUtil:
@@ -31,9 +53,61 @@ class MarkdownTableUtil:
                 results = the_file_content.splitlines()
         return results
 
+    BACKTICKS = re.compile(r"(`+)")
+    ESCAPED_PIPE = "\x00"
+
+    def split_row(line):
+        # split a table row into the stripped cells. | in code spans (`...`, ```...```) and escaped \| don't split the cell
+        is_escaped = "\\|" in line
+        if is_escaped:
+            line = line.replace("\\|", MarkdownTableUtil.ESCAPED_PIPE)
+        if "`" not in line:
+            cols = line.split("|")
+        else:
+            # [text, backticks, text, backticks, ..., text]
+            parts = MarkdownTableUtil.BACKTICKS.split(line)
+            cols = []
+            col = ""
+            i = 0
+            n = len(parts)
+            while i<n:
+                pieces = parts[i].split("|")
+                if len(pieces)>1:
+                    cols.append(col + pieces[0])
+                    cols.extend(pieces[1:-1])
+                    col = pieces[-1]
+                else:
+                    col += parts[i]
+                if i+1<n:
+                    # code span continues until the same length backticks
+                    j = i+3
+                    while j<n and parts[j]!=parts[i+1]:
+                        j += 2
+                    if j<n:
+                        col += "".join(parts[i+1:j+1])
+                        i = j+1
+                    else:
+                        col += parts[i+1]
+                        i += 2
+                else:
+                    i += 1
+            cols.append(col)
+        if is_escaped:
+            cols = [col.replace(MarkdownTableUtil.ESCAPED_PIPE, "|") for col in cols]
+
+        cols = [col.strip() for col in cols]
+        if len(cols)>1 and line.lstrip().startswith("|"):
+            cols = cols[1:]
+        if len(cols)>1 and line.rstrip().endswith("|") and not cols[-1]:
+            cols = cols[:-1]
+        return cols
+
+    def is_separator_line(line):
+        return "|" in line and (":--" in line or "--:" in line or ":-:" in line)
+
     def get_fields_pos(lines):
         for i, line in enumerate(lines):
-            if "|" in line and (":--" in line or "--:" in line or ":-:" in line):
+            if MarkdownTableUtil.is_separator_line(line):
                 return max(i-1,0)
         return None
 
@@ -43,9 +117,7 @@ class MarkdownTableUtil:
 
         pos = MarkdownTableUtil.get_fields_pos(lines)
         if pos!=None:
-            _fields = lines[pos].split("|") # TODO:should support ``````
-            for col in _fields:
-                col = col.strip()
+            for col in MarkdownTableUtil.split_row(lines[pos]):
                 if col:
                     fields.append( col )
             data = lines[min(pos+2, len(lines)):]
@@ -59,16 +131,12 @@ class MarkdownTableUtil:
             fields, data = MarkdownTableUtil.get_fields_and_data(lines)
             fields_len = len(fields)
             for line in data:
-                pos = line.find("|")
-                if pos!=None:
-                    line = line[pos+1:]
-                    pos = line.rfind("|")
-                    line = line[:pos]
-                    cols = line.split("|") # TODO:should support ``````
+                if "|" in line:
+                    cols = MarkdownTableUtil.split_row(line)
                     row = {}
                     for i, col in enumerate(cols):
                         if i<fields_len:
-                            row[fields[i]] = col.strip()
+                            row[fields[i]] = col
                     if row:
                         results.append(row)
         return results
@@ -134,6 +202,18 @@ class CppCheckerUtil:
 
     REQUIRED_FIELDS = "filename|line|id|message|commitId|theLine"
 
+    @staticmethod
+    def parse_line_number(col):
+        # 123 or [123](link)
+        pos1 = col.find("[")
+        pos2 = col.find("]")
+        if pos1!=-1 and pos2!=-1 and pos2>pos1:
+            col = col[pos1+1:pos2]
+        try:
+            return int(col)
+        except:
+            return None
+
     def parse_line(self, line):
         filename = None
         line_number = None
@@ -143,18 +223,11 @@ class CppCheckerUtil:
         the_line = None
 
         if line.startswith("| "):
-            cols = line.split(" | ")
+            cols = MarkdownTableUtil.split_row(line)
             if len(cols)==6:
-                filename = cols[0][2:].strip()
-                pos1 = cols[1].find("[")
-                pos2 = cols[1].find("]")
-                if pos1!=None and pos2!=None and pos2>pos1:
-                    cols[1] = cols[1][pos1+1:pos2]
-                try:
-                    line_number = int(cols[1])
-                except:
-                    pass
-                message_id = cols[2].strip()
+                filename = cols[0]
+                line_number = self.parse_line_number(cols[1])
+                message_id = cols[2]
                 message = cols[3]
                 commit_id = cols[4]
 
@@ -178,47 +251,225 @@ class CppCheckerUtil:
 
         return filename, line_number, message_id, message, commit_id, the_line
 
-    def parse_result(self, lines, target_path=None):
-        result = {}
-
+    def iter_findings(self, lines, target_path=None):
+        # yields (filename, line_number, message_id, message, commit_id) one by one
+        tree_index = DirectoryTreeIndex.get_index(target_path) if target_path else None
         for line in lines:
             filename, line_number, message_id, message, commit_id, the_line = self.parse_line(line)
             #print(f'{filename}, {line_number}, {message_id}, {message}, {commit_id}, {the_line}')
             if filename and line_number and message_id and message:
-                if not target_path or os.path.exists(os.path.join(target_path, filename)):
-                    if not filename in result:
-                        result[filename] = {}
-                    if not line_number in result[filename]:
-                        result[filename][line_number] = {}
-                    if not message_id in result[filename][line_number]:
-                        result[filename][line_number][message_id] = []
-                    result[filename][line_number][message_id].append(message)
+                if not tree_index or tree_index.exists(filename):
+                    yield filename, line_number, message_id, message, commit_id
+
+    @staticmethod
+    def add_finding(reports, line_number, message_id, message):
+        if not line_number in reports:
+            reports[line_number] = {}
+        if not message_id in reports[line_number]:
+            reports[line_number][message_id] = []
+        reports[line_number][message_id].append(message)
+
+    def parse_result(self, lines, target_path=None):
+        result = FindingStore()
+
+        for filename, line_number, message_id, message, commit_id in self.iter_findings(lines, target_path):
+            result.add(filename, line_number, message_id, message)
 
         return result
 
+    def iter_file_reports(self, findings):
+        # yields (filename, reports) each time the filename changes in the findings stream.
+        # CppChecker reports are grouped by file. if a file appears again later, it's yielded as another group.
+        current_filename = None
+        reports = {}
+        for filename, line_number, message_id, message, commit_id in findings:
+            if filename!=current_filename:
+                if reports:
+                    yield current_filename, reports
+                current_filename = filename
+                reports = {}
+            self.add_finding(reports, line_number, message_id, message)
+        if reports:
+            yield current_filename, reports
+
+    def get_exec_cmd(self, target_path):
+        return f'ruby {self.cppchecker_path} {target_path} -m detail -s --detailSection=\"{self.REQUIRED_FIELDS}\"'
+
     def execute(self, target_path):
         result = {}
-        if os.path.exists(args.cppcheck):
-            exec_cmd = f'ruby {self.cppchecker_path} {target_path} -m detail -s --detailSection=\"{self.REQUIRED_FIELDS}\"'
-
-            result = self.parse_result(ExecUtil.getExecResultEachLine(exec_cmd, target_path, False), target_path)
+        if os.path.exists(self.cppchecker_path):
+            result = self.parse_result(ExecUtil.getExecResultEachLine(self.get_exec_cmd(target_path), target_path, False), target_path)
 
         return result
 
+    def execute_findings_stream(self, target_path, files=None):
+        # yields (filename, line_number, message_id, message, commit_id) while CppChecker is running. CppChecker.rb always analyzes the whole target_path
+        if os.path.exists(self.cppchecker_path):
+            lines = ExecUtil.getExecResultEachLineStream(self.get_exec_cmd(target_path), target_path, False)
+            yield from self.iter_findings(lines, target_path)
+
+    def execute_stream(self, target_path):
+        # streaming version of execute. yields (filename, reports) while CppChecker is running
+        yield from self.iter_file_reports( self.execute_findings_stream(target_path) )
+
+    def iter_report_findings(self, report_path):
+        # single pass reader of the existing report. yields (filename, line_number, message_id, message, commit_id)
+        if os.path.exists(report_path):
+            with open(report_path, 'r', encoding='UTF-8') as f:
+                prev_line = None
+                field_pos = None
+                for line in f:
+                    if field_pos==None:
+                        if prev_line!=None and MarkdownTableUtil.is_separator_line(line):
+                            fields = MarkdownTableUtil.split_row(prev_line)
+                            field_pos = [fields.index(field) if field in fields else None for field in self.REQUIRED_FIELDS.split("|")[0:5]]
+                            if None in field_pos[0:4]:
+                                # not the findings table
+                                field_pos = None
+                        prev_line = line
+                    elif "|" in line:
+                        cols = MarkdownTableUtil.split_row(line)
+                        if len(cols)>max(field_pos[0:4]):
+                            filename = cols[field_pos[0]]
+                            line_number = self.parse_line_number(cols[field_pos[1]])
+                            message_id = cols[field_pos[2]]
+                            message = cols[field_pos[3]]
+                            commit_id = cols[field_pos[4]] if field_pos[4]!=None and field_pos[4]<len(cols) else None
+                            if filename and line_number and message_id and message:
+                                yield filename, line_number, message_id, message, commit_id
+
     def existing_summary_reader(self, summary_path):
-        data = MarkdownTableUtil.parse(summary_path)
-        new_md_table = MarkdownTableUtil.serialize(data, self.REQUIRED_FIELDS.split("|"))
-        results = self.parse_result(new_md_table)
+        results = FindingStore()
+        for filename, line_number, message_id, message, commit_id in self.iter_report_findings(summary_path):
+            results.add(filename, line_number, message_id, message)
         return results
 
 
+class CppCheckXmlUtil(CppCheckerUtil):
+    # reads cppcheck --xml --xml-version=2 output directly instead of CppChecker.rb's markdown
+    DEFAULT_OPTIONS = "--enable=warning,style,performance,portability"
+
+    def __init__(self, cppcheck_path="cppcheck", jobs=None, options=None):
+        super().__init__(cppcheck_path)
+        self.jobs = jobs if jobs else os.cpu_count()
+        self.options = options if options!=None else self.DEFAULT_OPTIONS
+
+    def normalize_filename(self, filename, target_path=None):
+        if target_path and os.path.isabs(filename):
+            filename = os.path.relpath(filename, target_path)
+        while filename.startswith("./"):
+            filename = filename[2:]
+        return filename
+
+    def iter_xml_events(self, xml_stream, chunk_size=65536):
+        # pull parser fed by read1() : events are available as soon as cppcheck writes them to the pipe
+        parser = ET.XMLPullParser(events=("start", "end"))
+        while True:
+            data = xml_stream.read1(chunk_size)
+            if not data:
+                break
+            parser.feed(data)
+            yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+
+    def iter_findings(self, xml_stream, target_path=None):
+        # yields (filename, line_number, message_id, message, commit_id). processed elements are cleared to keep the memory flat
+        errors = None
+        for event, elem in self.iter_xml_events(xml_stream):
+            if event=="start":
+                if elem.tag=="errors":
+                    errors = elem
+            elif elem.tag=="error":
+                location = elem.find("location")
+                message_id = elem.get("id")
+                message = elem.get("msg")
+                if location!=None and message_id and message:
+                    filename = self.normalize_filename(location.get("file", ""), target_path)
+                    try:
+                        line_number = int(location.get("line", "0"))
+                    except:
+                        line_number = 0
+                    if filename and line_number:
+                        yield filename, line_number, message_id, message, None
+                if errors!=None:
+                    errors.clear()
+                else:
+                    elem.clear()
+
+    def iter_file_reports(self, findings):
+        # cppcheck's xml isn't grouped by file (-j, the headers included by several sources). the findings of the same file are merged,
+        # then the files are yielded once the whole stream is read
+        result = FindingStore()
+        for filename, line_number, message_id, message, commit_id in findings:
+            result.add(filename, line_number, message_id, message)
+        yield from result.items()
+
+    def get_exec_cmd(self, target_path, files=None):
+        targets = " ".join([shlex.quote(filename) for filename in files]) if files else "."
+        return f'{self.cppchecker_path} --xml --xml-version=2 -j {self.jobs} {self.options} {targets}'
+
+    def execute_findings_stream(self, target_path, files=None):
+        # cppcheck writes the xml to stderr. parse it while cppcheck is running
+        if os.path.isdir(target_path):
+            proc = subprocess.Popen(self.get_exec_cmd(target_path, files), shell=True, cwd=target_path, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            is_killed = False
+            try:
+                yield from self.iter_findings(proc.stderr, target_path)
+            except ET.ParseError as e:
+                # e.g. cppcheck isn't found or it's crashed
+                print(f"ERROR!!!: failed to parse the cppcheck output of {target_path} ({e})", file=sys.stderr)
+            finally:
+                proc.stderr.close()
+                if proc.poll() == None:
+                    proc.kill()
+                    is_killed = True
+                proc.wait()
+                if not is_killed and proc.returncode!=0:
+                    print(f"ERROR!!!: cppcheck exited with {proc.returncode} for {target_path}", file=sys.stderr)
+
+    def execute(self, target_path):
+        result = FindingStore()
+        for filename, line_number, message_id, message, commit_id in self.execute_findings_stream(target_path):
+            result.add(filename, line_number, message_id, message)
+        return result
+
+    def iter_xml_report_findings(self, xml_path, target_path=None):
+        if os.path.exists(xml_path):
+            with open(xml_path, 'rb') as f:
+                try:
+                    yield from self.iter_findings(f, target_path)
+                except ET.ParseError as e:
+                    # e.g. truncated xml
+                    print(f"ERROR!!!: failed to parse {xml_path} ({e})", file=sys.stderr)
+
+    def existing_xml_reader(self, xml_path, target_path=None):
+        # yields (filename, reports) from the existing xml result file
+        yield from self.iter_file_reports( self.iter_xml_report_findings(xml_path, target_path) )
+
+
 class CppCheckerResolverWithLLM(GptQueryWithCheck):
     PROMPT_FILE = os.path.join(os.path.dirname(__file__), "cppcheck_resolver.json")
 
-    def __init__(self, client=None, promptfile=None):
+    def __init__(self, client=None, promptfile=None, rate_controller=None):
         if not promptfile:
             promptfile = self.PROMPT_FILE
-        super().__init__(client, promptfile)
+        super().__init__(client, promptfile, rate_controller)
+
+    STOP_SEQUENCES = ["[END]"]
+    OUTPUT_KEY = "resolution"
+
+    def get_max_output_tokens(self, lines):
+        # the resolved code is about the size of the window. allow some explanation
+        return len(lines) // 4 * 2 + 256
+
+    def create_stop_condition(self, replace_keydata={}):
+        return StreamStopCondition(self.STOP_SEQUENCES, 1, self.get_max_output_tokens(replace_keydata.get("[TARGET_LINES]", "")))
+
+    def get_prompt_version(self):
+        # changes when the prompt file is edited, then the cached resolutions of the old prompt aren't reused
+        prompt = json.dumps([self.system_prompt, self.user_prompt], ensure_ascii=False)
+        return hashlib.blake2b(prompt.encode("utf-8"), digest_size=8).hexdigest()
 
     def is_ok_query_result(self, query_result):
         # TODO: IMPROVE THIS
@@ -227,38 +478,208 @@ class CppCheckerResolverWithLLM(GptQueryWithCheck):
             return False
         return True
 
+    def get_replace_keydata(self, lines, relative_pos, message):
+        if isinstance(lines, list):
+            lines = "\n".join(lines)
+        return {
+            "[CPPCHECK]": message,
+            "[RELATIVE_POSITION]": relative_pos,
+            "[TARGET_LINES]": lines,
+        }
+
+    def generate_prompt(self, lines, relative_pos, message):
+        # (system_prompt, user_prompt, stop_condition) of the query e.g. for the offline batch
+        replace_keydata = self.get_replace_keydata(lines, relative_pos, message)
+        system_prompt, user_prompt = self._generate_prompt(replace_keydata)
+        return system_prompt, user_prompt, self.create_stop_condition(replace_keydata)
+
+    def get_resolution(self, lines, query_result):
+        # the resolution of the query result which is obtained out of query() e.g. the offline batch. None if it's not acceptable
+        replace_keydata = self.get_replace_keydata(lines, 0, "")
+        if query_result:
+            # same as the live query. trim() relies on the code fences counted by is_done()
+            stop_condition = self.create_stop_condition(replace_keydata)
+            stop_condition.is_done(query_result)
+            query_result = stop_condition.trim(query_result)
+        return query_result if self.check_query_result(query_result, replace_keydata) else None
+
     def query(self, lines, relative_pos, message):
+        return super().query( self.get_replace_keydata(lines, relative_pos, message) )
+
+
+class CppCheckerDiffResolverWithLLM(CppCheckerResolverWithLLM):
+    # asks a minimal unified diff against the window instead of the whole resolved code
+    PROMPT_FILE = os.path.join(os.path.dirname(__file__), "cppcheck_resolver_diff.json")
+    OUTPUT_KEY = "diff"
+
+    def get_max_output_tokens(self, lines):
+        return len(lines) // 4 + 256
+
+    def is_applicable(self, lines, query_result):
+        diff = DiffUtil.extract_diff(query_result) if query_result else None
+        if diff and DiffUtil.apply(str(lines).splitlines(), diff)!=None:
+            return diff
+        return None
+
+    def check_query_result(self, query_result, replace_keydata={}):
+        return self.is_applicable(replace_keydata.get("[TARGET_LINES]", ""), query_result)!=None
+
+    def get_resolution(self, lines, query_result):
+        return self.is_applicable(lines, query_result)
+
+    def query(self, lines, relative_pos, message):
+        if isinstance(lines, list):
+            lines = "\n".join(lines)
+        query_result, response = super().query(lines, relative_pos, message)
+        return self.is_applicable(lines, query_result), response
+
+
+class CppCheckerBatchResolverWithLLM(CppCheckerResolverWithLLM):
+    # resolves several findings in the same code window with one query
+    PROMPT_FILE = os.path.join(os.path.dirname(__file__), "cppcheck_resolver_batch.json")
+    FINDING_SECTION = re.compile(r'^#{1,6}\s*FINDING\s+(\d+)\s*$', re.MULTILINE)
+
+    def split_resolutions(self, query_result):
+        # "### FINDING 1\n...### FINDING 2\n..." -> {0: "...", 1: "..."}
+        results = {}
+        sections = self.FINDING_SECTION.split(str(query_result))
+        for i in range(1, len(sections)-1, 2):
+            resolution = sections[i+1].strip()
+            if resolution:
+                results[int(sections[i])-1] = resolution
+        return results
+
+    def is_ok_query_result(self, query_result):
+        return len(self.split_resolutions(query_result))>0
+
+    def create_stop_condition(self, replace_keydata={}):
+        num_findings = len(replace_keydata.get("[FINDINGS]", "").splitlines())
+        return StreamStopCondition(self.STOP_SEQUENCES, num_findings, self.get_max_output_tokens(replace_keydata.get("[TARGET_LINES]", "")) * max(num_findings, 1))
+
+    def query_batch(self, lines, findings):
+        # findings : [(relative_pos, message)]. returns {index of findings: resolution}
         if isinstance(lines, list):
             lines = "\n".join(lines)
 
+        _findings = []
+        for i, (relative_pos, message) in enumerate(findings):
+            message = message.replace("\n", " / ")
+            _findings.append(f"{i+1}:{relative_pos}:{message}")
+
         replace_keydata={
-            "[CPPCHECK]": message,
-            "[RELATIVE_POSITION]": relative_pos,
+            "[FINDINGS]": "\n".join(_findings),
             "[TARGET_LINES]": lines,
         }
-        return super().query(replace_keydata)
+        query_result, _ = GptQueryWithCheck.query(self, replace_keydata)
+        results = {}
+        if query_result:
+            for i, resolution in self.split_resolutions(query_result).items():
+                if i>=0 and i<len(findings):
+                    results[i] = resolution
+        return results
+
+
+class ResolverStats:
+    # thread safe counters e.g. findings, cache_hits, llm_calls
+    def __init__(self, name=""):
+        self.name = name
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.start_time = time.time()
+        self.end_time = None
+
+    def increment(self, key, count=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + count
+
+    def get(self, key):
+        return self.counters.get(key, 0)
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def elapsed(self):
+        return (self.end_time if self.end_time else time.time()) - self.start_time
+
+    def throughput(self, key="findings"):
+        elapsed = self.elapsed()
+        return self.get(key) / elapsed if elapsed>0 else 0
 
 
 class CppCheckerResolver:
     CACHE_ID = "CppCheckerResolver"
 
-    def __init__(self, resolver, margin_lines=10):
+    def __init__(self, resolver, margin_lines=10, max_workers=1, cache_backend=None, num_of_cache=None, max_cache_bytes=None, max_llm_calls=None, batch_resolver=None, local_resolver=None, similarity_index=None, offline_batch=None, context_extractor=None, memory_cache_entries=None):
         self.resolver = resolver
+        self.batch_resolver = batch_resolver
+        self.local_resolver = local_resolver
+        self.similarity_index = similarity_index
+        # OfflineBatchWriter : the cache misses are written as the offline batch instead of querying LLM
+        self.offline_batch = offline_batch
+        # CodeContextExtractor : the enclosing function or class within the token budget instead of +-margin_lines
+        self.context_extractor = context_extractor
         self.margin_lines = margin_lines
-        self.cache = JsonCache(os.path.join(JsonCache.DEFAULT_CACHE_BASE_DIR, self.CACHE_ID),  JsonCache.CACHE_INFINITE)
+        self.cache = JsonCache(os.path.join(JsonCache.DEFAULT_CACHE_BASE_DIR, self.CACHE_ID),  JsonCache.CACHE_INFINITE, num_of_cache, cache_backend, max_cache_bytes, memory_cache_entries)
+        self.executor = None
+        if max_workers>1:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # global cap of the concurrent LLM queries even if the findings are resolved from several module threads
+        self.llm_semaphore = threading.BoundedSemaphore(max_llm_calls if max_llm_calls else max(max_workers, 1))
+        self.stats = ResolverStats()
+        # fingerprint of the query -> future of its response. shared by the identical queries across the files in this run
+        self.queries = {}
+        self.queries_lock = threading.Lock()
+        # seconds to keep the completed queries. None keeps them until the end of the run
+        # the long running server expires them since the table would grow with every request
+        self.query_ttl = None
+        # fingerprint -> expiration time of the completed queries in the completion order
+        self.query_expirations = {}
 
     def reset_cache(self):
-        self.cache.clearAllCache(self.CACHE_ID)
+        self.cache.clear()
+        if self.similarity_index:
+            self.similarity_index.clear()
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        self.cache.close()
 
 
     def extract_target_lines(self, lines, target_line, margin_lines=None):
+        # lines[target_line-1] is the reported line. relative_pos is its line number in the target lines
+        if margin_lines==None and self.context_extractor:
+            start_pos, end_pos = self.context_extractor.get_window(lines, target_line-1)
+            return "\n".join(lines[start_pos:end_pos]), target_line-start_pos
         if margin_lines==None:
             margin_lines = self.margin_lines
-        start_pos = max(target_line-margin_lines, 0)
-        end_pos = min(target_line+margin_lines, len(lines))
+        start_pos = max(target_line-1-margin_lines, 0)
+        end_pos = min(target_line-1+margin_lines, len(lines))
         target_lines = "\n".join(lines[start_pos:end_pos])
         return target_lines, target_line-start_pos
 
+    def extract_key_lines(self, filename, lines, target_line, margin_lines=3):
+        # the cache keys were computed with the lines which IGpt.files_reader enclosed by the code fence. keep them to reuse the cache
+        head = []
+        tail = []
+        if IGpt.add_code_section("", filename):
+            head = ["```"]
+            tail = ([""] if getattr(lines, "final_newline", False) else []) + ["```"]
+        num_of_lines = len(head) + len(lines) + len(tail)
+        start_pos = max(target_line-margin_lines, 0)
+        end_pos = min(target_line+margin_lines, num_of_lines)
+        target_lines = []
+        for i in range(start_pos, end_pos):
+            i -= len(head)
+            if i<0:
+                target_lines.append(head[0])
+            elif i<len(lines):
+                target_lines.append(lines[i])
+            else:
+                target_lines.append(tail[i-len(lines)])
+        return "\n".join(target_lines), target_line-start_pos
+
     def cut_off_string(self, input_string, max_length):
         input_string_length = len(input_string)
         input_string_length = min(input_string_length, max_length)
@@ -267,8 +688,21 @@ class CppCheckerResolver:
     MAX_FILENAME_LENGTH = 240
     BUDGET_FILENAME_LENGTH = 128
 
+    CACHE_KEY_VERSION = "2"
+
+    def normalize_lines(self, target_lines):
+        return "\n".join( [" ".join(line.split()) for line in target_lines.splitlines()] )
+
     def get_cache_identifier(self, filename, lines, target_line, report):
-        target_lines, relative_pos = self.extract_target_lines(lines, target_line, 3)
+        # content-addressed key : digest of the filename, the normalized snippet, the relative position, the message ids and the prompt version
+        target_lines, relative_pos = self.extract_key_lines(filename, lines, target_line)
+        prompt_version = self.resolver.get_prompt_version() if hasattr(self.resolver, "get_prompt_version") else ""
+
+        key = "\0".join([self.CACHE_KEY_VERSION, filename, self.normalize_lines(target_lines), str(relative_pos), report, prompt_version])
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=20).hexdigest()
+
+    def get_legacy_cache_identifier(self, filename, lines, target_line, report):
+        target_lines, relative_pos = self.extract_key_lines(filename, lines, target_line)
 
         allowed_length = max(self.MAX_FILENAME_LENGTH-len(filename), 0)
         if allowed_length==0:
@@ -282,45 +716,518 @@ class CppCheckerResolver:
 
         return uri
 
-    def execute(self, base_dir, filename, reports, is_only_new):
-        resolved_outputs = []
-        target_path = os.path.join(base_dir, filename)
-        lines = IGpt.files_reader(target_path)
-        lines = lines.splitlines()
+    def get_messages(self, messages):
+        message_id = "_".join(messages.keys())
+        multiple_messages = []
+        for _messages in messages.values():
+            multiple_messages.extend(_messages)
+        return message_id, "\n".join(multiple_messages)
+
+    def restore_from_cache(self, filename, lines, line_number, message_id):
+        uri = self.get_cache_identifier(filename, lines, line_number, message_id)
+        resolved_output = self.cache.restoreFromCache(uri)
+        if resolved_output==None:
+            # compatibility : entry stored with the legacy key. store it with the new key for the next time
+            resolved_output = self.cache.restoreFromCache( self.get_legacy_cache_identifier(filename, lines, line_number, message_id) )
+            if resolved_output!=None:
+                self.cache.storeToCache(uri, resolved_output)
+        return uri, resolved_output
+
+    def get_similarity_kind(self, message_id):
+        # resolutions are reusable only for the same message ids with the same prompt
+        prompt_version = self.resolver.get_prompt_version() if hasattr(self.resolver, "get_prompt_version") else ""
+        return message_id + "\0" + prompt_version
+
+    def restore_from_similar(self, uri, filename, lines, line_number, message_id, flatten_messages):
+        # reuses the resolution of the near-identical snippet e.g. the file is moved or reformatted
+        target_lines, relative_pos = self.extract_target_lines(lines, line_number)
+        for distance, similar_uri in self.similarity_index.find(self.get_similarity_kind(message_id), target_lines):
+            if distance>self.similarity_index.max_distance:
+                print(f"SIMILAR: rejected for {filename}:{line_number} {message_id} (distance {distance} > {self.similarity_index.max_distance})", file=sys.stderr)
+                break
+            similar_output = self.cache.restoreFromCache(similar_uri) if similar_uri!=uri else None
+            if similar_output!=None:
+                output_key = "diff" if "diff" in similar_output else "resolution"
+                window = None
+                if output_key=="diff":
+                    start_pos = line_number-relative_pos
+                    window = [start_pos, start_pos+len(target_lines.splitlines())]
+                print(f"SIMILAR: reused {similar_output.get('filename')}:{similar_output.get('pos')} for {filename}:{line_number} {message_id} (distance {distance})", file=sys.stderr)
+                return self.store_resolution(uri, filename, line_number, flatten_messages, similar_output.get(output_key, ""), output_key, window)
+        return None
+
+    def add_to_similarity_index(self, uri, lines, line_number, message_id):
+        target_lines, _ = self.extract_target_lines(lines, line_number)
+        self.similarity_index.put(self.get_similarity_kind(message_id), target_lines, uri)
+
+    def store_resolution(self, uri, filename, line_number, flatten_messages, resolution, output_key="resolution", window=None):
+        resolved_output = {"filename": filename, "pos": line_number, "message": flatten_messages, output_key: resolution}
+        if window:
+            # to rebuild the resolved code from the diff
+            resolved_output["window"] = window
+        self.cache.storeToCache(uri, resolved_output )
+        return resolved_output
+
+    def read_lines(self, path):
+        # memory mapped lines shared by the findings of the file. lines[i] is the line i+1
+        return SourceFileIndex.get_shared().get_lines(path)
+
+    def get_resolution_text(self, resolved_output, base_dir=None, is_full_code=False):
+        # the diff is applied to the current file only if the full code is required
+        if "diff" in resolved_output:
+            diff = resolved_output["diff"]
+            if is_full_code and base_dir and "window" in resolved_output:
+                start_pos, end_pos = resolved_output["window"]
+                lines = self.read_lines(os.path.join(base_dir, resolved_output["filename"]))
+                resolved_lines = DiffUtil.apply(lines[start_pos:end_pos], diff)
+                if resolved_lines!=None:
+                    return "```\n" + "\n".join(resolved_lines) + "\n```"
+            return "```diff\n" + diff + "\n```"
+        return resolved_output.get("resolution", "")
+
+    def increment(self, stats, key, count=1):
+        self.stats.increment(key, count)
+        if stats:
+            stats.increment(key, count)
+
+    def get_query_fingerprint(self, target_lines, findings):
+        # findings : [(relative_pos, flatten_messages)]. the same snippet with the same findings is the same query regardless of the filename
+        key = "\0".join([self.normalize_lines(target_lines)] + [f"{relative_pos}\0{flatten_messages}" for relative_pos, flatten_messages in findings])
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=20).hexdigest()
+
+    def query_once(self, fingerprint, query, stats, count=1):
+        # only the first one of the identical queries reaches LLM. the others wait for and share its response
+        with self.queries_lock:
+            self.expire_queries()
+            future = self.queries.get(fingerprint)
+            is_owner = future==None
+            if is_owner:
+                future = Future()
+                self.queries[fingerprint] = future
+        if not is_owner:
+            self.increment(stats, "deduplicated", count)
+            return future.result()
+        try:
+            with self.llm_semaphore:
+                result = query()
+        except Exception as e:
+            with self.queries_lock:
+                # the next occurrence should try again
+                del self.queries[fingerprint]
+            future.set_exception(e)
+            raise
+        self.increment(stats, "llm_calls")
+        self.increment(stats, "queried_findings", count)
+        future.set_result(result)
+        if self.query_ttl!=None:
+            with self.queries_lock:
+                self.query_expirations[fingerprint] = time.time() + self.query_ttl
+        return result
 
-        for line_number, messages in reports.items():
-            message_id = "_".join(messages.keys())
-            multiple_messages = []
-            for _messages in messages.values():
-                multiple_messages.extend(_messages)
+    def expire_queries(self):
+        # call with queries_lock
+        now = time.time()
+        while self.query_expirations:
+            fingerprint, expiration = next(iter(self.query_expirations.items()))
+            if expiration>now:
+                break
+            del self.query_expirations[fingerprint]
+            self.queries.pop(fingerprint, None)
+
+    def query_and_store(self, uri, filename, lines, line_number, flatten_messages, stats):
+        resolved_output = None
+        target_lines, relative_pos = self.extract_target_lines(lines, line_number)
+        if target_lines and self.offline_batch:
+            self.add_offline_query(uri, filename, line_number, flatten_messages, target_lines, relative_pos, stats)
+        elif target_lines:
+            fingerprint = self.get_query_fingerprint(target_lines, [(relative_pos, flatten_messages)])
+            resolution, _ = self.query_once(fingerprint, lambda: self.resolver.query(target_lines, relative_pos, flatten_messages), stats)
+            if resolution:
+                output_key = getattr(self.resolver, "OUTPUT_KEY", "resolution")
+                resolved_output = self.store_resolution(uri, filename, line_number, flatten_messages, resolution, output_key, self.get_window(line_number, relative_pos, target_lines))
+        return resolved_output
+
+    def resolve_locally(self, uri, filename, lines, line_number, messages, flatten_messages, stats):
+        # deterministic fix by the local rules. None if any of the message ids has no matching rule
+        resolved_output = None
+        target_lines, relative_pos = self.extract_target_lines(lines, line_number)
+        if target_lines:
+            resolution = self.local_resolver.resolve(target_lines, relative_pos, messages)
+            if resolution:
+                self.increment(stats, "rule_resolved")
+                resolved_output = self.store_resolution(uri, filename, line_number, flatten_messages, resolution)
+        return resolved_output
+
+    def get_window(self, line_number, relative_pos, target_lines):
+        # [start, end) of the window in the file. required to rebuild the resolved code from the diff
+        if getattr(self.resolver, "OUTPUT_KEY", "resolution")=="diff":
+            start_pos = line_number-relative_pos
+            return [start_pos, start_pos+len(target_lines.splitlines())]
+        return None
 
-            uri = self.get_cache_identifier(filename, lines, line_number, message_id)
-            resolved_output = self.cache.restoreFromCache(uri)
+    def add_offline_query(self, uri, filename, line_number, flatten_messages, target_lines, relative_pos, stats):
+        # custom_id is the fingerprint of the query. then the identical queries are sent once
+        custom_id = self.get_query_fingerprint(target_lines, [(relative_pos, flatten_messages)])
+        system_prompt, user_prompt, stop_condition = self.resolver.generate_prompt(target_lines, relative_pos, flatten_messages)
+        finding = {"uri": uri, "filename": filename, "pos": line_number, "message": flatten_messages, "lines": target_lines, "window": self.get_window(line_number, relative_pos, target_lines)}
+        self.offline_batch.add(custom_id, system_prompt, user_prompt, stop_condition, finding)
+        self.increment(stats, "offline_queued")
+
+    def ingest_offline_results(self, results_path, manifest_path):
+        # stores the results of the offline batch to the cache in bulk. returns (number of stored findings, number of failed findings)
+        manifest = OfflineBatchReader.read_manifest(manifest_path)
+        output_key = getattr(self.resolver, "OUTPUT_KEY", "resolution")
+        stored = failed = 0
+        items = []
+        for custom_id, content in OfflineBatchReader.iter_results(results_path):
+            findings = manifest.pop(custom_id, [])
+            for finding in findings:
+                resolution = self.resolver.get_resolution(finding["lines"], content) if content else None
+                if resolution:
+                    resolved_output = {"filename": finding["filename"], "pos": finding["pos"], "message": finding["message"], output_key: resolution}
+                    if finding.get("window"):
+                        resolved_output["window"] = finding["window"]
+                    items.append( (finding["uri"], resolved_output) )
+                    stored += 1
+                else:
+                    failed += 1
+            if len(items)>=1024:
+                self.cache.storeManyToCache(items)
+                items = []
+        if items:
+            self.cache.storeManyToCache(items)
+        self.cache.flush()
+        # the findings without the result
+        failed += sum(len(findings) for findings in manifest.values())
+        return stored, failed
+
+    def query_batch_and_store(self, filename, lines, misses, stats):
+        # misses : [(index, line_number, flatten_messages, uri)] in a merged window. returns {index: resolved_output}
+        results = {}
+        start_pos = max(misses[0][1]-1-self.margin_lines, 0)
+        end_pos = min(misses[-1][1]-1+self.margin_lines, len(lines))
+        target_lines = "\n".join(lines[start_pos:end_pos])
+        if target_lines:
+            findings = [(line_number-start_pos, flatten_messages) for _, line_number, flatten_messages, _ in misses]
+            fingerprint = self.get_query_fingerprint(target_lines, findings)
+            resolutions = self.query_once(fingerprint, lambda: self.batch_resolver.query_batch(target_lines, findings), stats, len(misses))
+            self.increment(stats, "batched_findings", len(misses))
+            for n, (i, line_number, flatten_messages, uri) in enumerate(misses):
+                if n in resolutions:
+                    results[i] = self.store_resolution(uri, filename, line_number, flatten_messages, resolutions[n])
+        return results
 
+    def resolve_batch(self, filename, lines, findings, is_only_new, stats=None):
+        # findings : [(line_number, messages)]. returns the resolved outputs in the same order
+        resolved_outputs = [None] * len(findings)
+        misses = []
+        queried = []
+        for i, (line_number, messages) in enumerate(findings):
+            self.increment(stats, "findings")
+            message_id, flatten_messages = self.get_messages(messages)
+            uri, resolved_output = self.restore_from_cache(filename, lines, line_number, message_id)
+            if resolved_output==None and self.similarity_index:
+                resolved_output = self.restore_from_similar(uri, filename, lines, line_number, message_id, flatten_messages)
+                if resolved_output:
+                    self.increment(stats, "similar_reused")
+            if resolved_output==None and self.local_resolver:
+                resolved_output = self.resolve_locally(uri, filename, lines, line_number, messages, flatten_messages, stats)
+                if resolved_output:
+                    resolved_outputs[i] = resolved_output
+                    continue
             if resolved_output==None:
                 # no hit in the cache
-                flatten_messages = "\n".join(multiple_messages)
-                target_lines, relative_pos = self.extract_target_lines(lines, line_number)
-                if target_lines:
-                    resolved_output, _ = self.resolver.query(target_lines, relative_pos, flatten_messages)
-                    if resolved_output:
-                        resolved_output = {"filename": filename, "pos": line_number, "message": flatten_messages, "resolution": resolved_output}
-                        self.cache.storeToCache(uri, resolved_output )
-            elif is_only_new:
-                # found in cache & only_new then should omit
-                resolved_output = None
+                misses.append( (i, line_number, flatten_messages, uri) )
+                queried.append( (i, line_number, message_id, uri) )
+            else:
+                self.increment(stats, "cache_hits")
+                if not is_only_new:
+                    # found in cache & only_new then should omit
+                    resolved_outputs[i] = resolved_output
+
+        if self.batch_resolver and len(misses)>1 and not self.offline_batch:
+            for i, resolved_output in self.query_batch_and_store(filename, lines, misses, stats).items():
+                resolved_outputs[i] = resolved_output
+            # fallback to the query per finding if the batch response lacks some of them
+            misses = [miss for miss in misses if resolved_outputs[miss[0]]==None]
+
+        for i, line_number, flatten_messages, uri in misses:
+            resolved_outputs[i] = self.query_and_store(uri, filename, lines, line_number, flatten_messages, stats)
+
+        if self.similarity_index:
+            for i, line_number, message_id, uri in queried:
+                if resolved_outputs[i]:
+                    self.add_to_similarity_index(uri, lines, line_number, message_id)
+
+        for resolved_output in resolved_outputs:
+            if resolved_output:
+                self.increment(stats, "resolved")
+        return resolved_outputs
+
+    def resolve(self, filename, lines, line_number, messages, is_only_new, stats=None):
+        return self.resolve_batch(filename, lines, [(line_number, messages)], is_only_new, stats)[0]
 
+    MAX_BATCH_FINDINGS = 8
+
+    def get_batch_groups(self, findings):
+        # merges the findings whose +-margin_lines windows overlap or are adjacent
+        groups = []
+        for line_number, messages in sorted(findings, key=lambda x: x[0]):
+            if groups and line_number-groups[-1][-1][0] <= self.margin_lines*2 and len(groups[-1])<self.MAX_BATCH_FINDINGS:
+                groups[-1].append( (line_number, messages) )
+            else:
+                groups.append( [(line_number, messages)] )
+        return groups
+
+    def fan_out(self, group_future, futures):
+        # sets each finding's future from the future of the group
+        def on_done(_future):
+            if _future.exception():
+                for future in futures:
+                    future.set_exception(_future.exception())
+            else:
+                for future, result in zip(futures, _future.result()):
+                    future.set_result(result)
+        group_future.add_done_callback(on_done)
+
+    def submit(self, base_dir, filename, reports, is_only_new, stats=None):
+        # returns futures of the findings. they're resolved on the worker threads if max_workers>1
+        futures = []
+        lines = self.read_lines(os.path.join(base_dir, filename))
+
+        findings = list(reports.items())
+        groups = self.get_batch_groups(findings) if self.batch_resolver else [[finding] for finding in findings]
+        for group in groups:
+            if self.executor:
+                group_future = self.executor.submit(self.resolve_batch, filename, lines, group, is_only_new, stats)
+            else:
+                group_future = Future()
+                group_future.set_result( self.resolve_batch(filename, lines, group, is_only_new, stats) )
+            group_futures = [Future() for _ in group]
+            self.fan_out(group_future, group_futures)
+            futures.extend(group_futures)
+
+        return futures
+
+    def collect(self, futures):
+        resolved_outputs = []
+        for future in futures:
+            resolved_output = future.result()
             if resolved_output:
                 resolved_outputs.append(resolved_output)
-
         return resolved_outputs
 
+    def execute(self, base_dir, filename, reports, is_only_new):
+        return self.collect( self.submit(base_dir, filename, reports, is_only_new) )
+
+
+class ResolvedOutputWriter:
+    # prints resolutions in the submitted order as soon as the head of the queue is resolved
+    def __init__(self, resolver, max_pending=64, out=None, is_full_code=False):
+        self.resolver = resolver
+        self.max_pending = max_pending
+        self.out = out if out else sys.stdout
+        self.is_full_code = is_full_code
+        self.pending = deque()
+        self.num_pending = 0
+
+    def add(self, filename, futures, base_dir=None):
+        self.pending.append( (filename, futures, base_dir) )
+        self.num_pending += len(futures)
+        # back pressure : wait for the head to keep the memory flat if the resolver is slower than the ingestion
+        while self.num_pending > self.max_pending:
+            self.write_head()
+        self.flush(False)
+
+    def add_callback(self, callback):
+        # callback() is called when everything added before is written
+        self.pending.append( (None, [], callback) )
+        self.flush(False)
+
+    def write_head(self):
+        filename, futures, base_dir = self.pending.popleft()
+        if filename==None:
+            callback = base_dir
+            callback()
+            return
+        self.num_pending -= len(futures)
+        self.print_resolved_outputs(filename, self.resolver.collect(futures), base_dir)
+
+    def flush(self, wait=True):
+        while self.pending and ( wait or all(future.done() for future in self.pending[0][1]) ):
+            self.write_head()
+
+    def print_resolved_outputs(self, filename, resolved_outputs, base_dir=None):
+        resolved_outputs = sorted(resolved_outputs, key=lambda x: (x["filename"], x["pos"]))
+        if resolved_outputs:
+            out = self.out
+            print(f"# {filename}", file=out)
+            print("", file=out)
+            for resolved_output in resolved_outputs:
+                _resolved = resolved_output["message"].split("\n")[0]
+                print(f"## {_resolved} (line:{resolved_output['pos']})", file=out)
+                #print(f"## {resolved_output["message"].split("\n")[0]} (line:{resolved_output["pos"]})")
+                print("", file=out)
+                print(self.resolver.get_resolution_text(resolved_output, base_dir, self.is_full_code), file=out)
+                print("", file=out)
+            out.flush()
+
+
+class TargetReader:
+    # "target_path" or "target_path:report_path" -> (target_path, iterable of (filename, reports))
+    def __init__(self, cppchecker, cppcheck_xml, is_stream=False, incremental_filter=None):
+        self.cppchecker = cppchecker
+        self.cppcheck_xml = cppcheck_xml
+        self.is_stream = is_stream
+        self.incremental_filter = incremental_filter
+
+    @staticmethod
+    def expand_target_paths(target_args):
+        # absolute "target_path" or "target_path:report_path". summary.md is expanded to the modules' reports
+        target_paths = []
+        for target_path in target_args:
+            if ":" in target_path:
+                _paths = target_path.split(":")
+                target_path = os.path.abspath(os.path.expanduser(_paths[0].strip())).strip()
+                report_path = os.path.abspath(os.path.expanduser(_paths[1].strip())).strip()
+                if report_path.endswith("summary.md"):
+                    summary = SummaryReader(report_path, target_path)
+                    reports = summary.parse()
+                    for report in reports:
+                        target_paths.append(os.path.join(target_path, report["path"])+":"+report["report_path"])
+                else:
+                    target_paths.append(target_path+":"+report_path)
+            else:
+                target_paths.append(target_path)
+        return target_paths
+
+    def read(self, target_path):
+        if self.incremental_filter:
+            return self.read_incremental(target_path)
+        results = {}
+        if ":" in target_path:
+            _paths = target_path.split(":")
+            target_path = _paths[0]
+            report_path = _paths[1]
+            if report_path.endswith(".xml"):
+                results = self.cppcheck_xml.existing_xml_reader(report_path, target_path)
+            else:
+                results = self.cppchecker.existing_summary_reader(report_path).items()
+        elif self.is_stream:
+            results = self.cppchecker.execute_stream(target_path)
+        else:
+            results = self.cppchecker.execute(target_path).items()
+        return target_path, results
+
+    def read_incremental(self, target_path):
+        # only the findings in the changed hunks. the target without any change isn't analyzed at all
+        report_path = None
+        if ":" in target_path:
+            _paths = target_path.split(":")
+            target_path = _paths[0]
+            report_path = _paths[1]
+        files = self.incremental_filter.get_changed_files(target_path)
+        if not files:
+            return target_path, []
+        reader = self.cppchecker
+        if report_path==None:
+            findings = self.cppchecker.execute_findings_stream(target_path, files)
+        elif report_path.endswith(".xml"):
+            reader = self.cppcheck_xml
+            findings = self.cppcheck_xml.iter_xml_report_findings(report_path, target_path)
+        else:
+            findings = self.cppchecker.iter_report_findings(report_path)
+        results = reader.iter_file_reports( self.incremental_filter.filter(target_path, findings) )
+        if not self.is_stream:
+            results = list(results)
+        return target_path, results
+
+
+class ModuleScheduler:
+    # processes the modules in parallel and outputs each module's result in the order of the modules
+    def __init__(self, target_reader, resolver, is_only_new, max_workers=4, is_full_code=False, journal=None):
+        self.target_reader = target_reader
+        self.resolver = resolver
+        self.is_only_new = is_only_new
+        self.max_workers = max_workers
+        self.is_full_code = is_full_code
+        self.journal = journal
+        self.module_stats = []
+
+    def get_module_name(self, target_path):
+        return os.path.basename(os.path.normpath(target_path.split(":")[0]))
+
+    def write_target(self, target_path, stats, out, max_pending=sys.maxsize):
+        writer = ResolvedOutputWriter(self.resolver, max_pending, out, self.is_full_code)
+        base_path, results = self.target_reader.read(target_path)
+        for filename, reports in results:
+            writer.add(filename, self.resolver.submit(base_path, filename, reports, self.is_only_new, stats), base_path)
+        writer.flush()
+        stats.finish()
+
+    def process(self, target_path, stats):
+        out = io.StringIO()
+        self.write_target(target_path, stats, out)
+        return out.getvalue()
+
+    @staticmethod
+    def get_stats_text(stats):
+        return f"{stats.name}: {stats.get('findings')} findings, {stats.get('resolved')} resolved, {stats.get('llm_calls')} LLM calls, {stats.get('rule_resolved')} by rules, {stats.get('deduplicated')} deduplicated, {stats.elapsed():.1f}s"
+
+    def execute(self, target_paths, out=None):
+        out = out if out else sys.stdout
+        total = len(target_paths)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = []
+            for target_path in target_paths:
+                stats = ResolverStats(self.get_module_name(target_path))
+                self.module_stats.append(stats)
+                if self.journal and self.journal.is_done(target_path):
+                    # completed in the previous run
+                    future = Future()
+                    future.set_result( self.journal.get_output(target_path) )
+                    stats.finish()
+                else:
+                    future = executor.submit(self.process, target_path, stats)
+                futures.append(future)
+            for i, future in enumerate(futures):
+                stats = self.module_stats[i]
+                try:
+                    output = future.result()
+                    out.write( output )
+                    out.flush()
+                    if self.journal and not self.journal.is_done(target_paths[i]):
+                        self.journal.put_done(target_paths[i], output)
+                except Exception as e:
+                    print(f"ERROR!!!: {stats.name} : {e}", file=sys.stderr)
+                print(f"[{i+1}/{total}] {self.get_stats_text(stats)}", file=sys.stderr)
+
+    def print_summary(self, out=None):
+        out = out if out else sys.stderr
+        print("", file=out)
+        print("| module | findings | cache hits | LLM calls | resolved | elapsed(s) | findings/s |", file=out)
+        print("| :--- | ---: | ---: | ---: | ---: | ---: | ---: |", file=out)
+        for stats in self.module_stats:
+            print(f"| {stats.name} | {stats.get('findings')} | {stats.get('cache_hits')} | {stats.get('llm_calls')} | {stats.get('resolved')} | {stats.elapsed():.1f} | {stats.throughput():.2f} |", file=out)
+        total = self.resolver.stats
+        print(f"| total | {total.get('findings')} | {total.get('cache_hits')} | {total.get('llm_calls')} | {total.get('resolved')} | {total.elapsed():.1f} | {total.throughput():.2f} |", file=out)
+
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser(description='CppCheck Resolver')
-    parser.add_argument('args', nargs='*', help='target folder or android_home or target_folder:report.md')
+    parser.add_argument('args', nargs='*', help='target folder or android_home or target_folder:report.md or target_folder:cppcheck_result.xml')
     parser.add_argument('--cppcheck', default=os.path.dirname(os.path.abspath(__file__))+"/../CppChecker/CppChecker.rb", help='Specify the path for CppChecker.rb')
+    parser.add_argument('--usecppcheck', action='store_true', default=False, help='specify if you want to run cppcheck directly instead of CppChecker.rb')
+    parser.add_argument('--cppcheckbin', default="cppcheck", help='Specify the path for cppcheck (with --usecppcheck)')
+    parser.add_argument('--cppcheckjobs', default=os.cpu_count(), type=int, action='store', help='Specify -j of cppcheck (with --usecppcheck)')
+    parser.add_argument('--cppcheckoptions', default=CppCheckXmlUtil.DEFAULT_OPTIONS, action='store', help='Specify options of cppcheck (with --usecppcheck)')
     parser.add_argument('-m', '--marginline', default=10, type=int, action='store', help='Specify margin lines')
+    parser.add_argument('--scopecontext', action='store_true', default=False, help='specify if you want to send the enclosing function or class of the finding instead of +-marginline lines')
+    parser.add_argument('--tokenbudget', default=CodeContextExtractor.DEFAULT_TOKEN_BUDGET, type=int, action='store', help='specify max (estimated) tokens of the code sent per finding (with --scopecontext)')
+    parser.add_argument('--maxsourcebytes', default=SourceFileIndex.DEFAULT_MAX_BYTES, type=int, action='store', help='specify max total bytes of the source files kept mapped (least recently used ones are dropped)')
+    parser.add_argument('-j', '--jobs', default=1, type=int, action='store', help='Specify number of concurrent LLM queries')
+    parser.add_argument('--modulejobs', default=1, type=int, action='store', help='Specify number of modules processed in parallel')
+    parser.add_argument('--maxllmcalls', default=None, type=int, action='store', help='Specify global max number of concurrent LLM calls (default:--jobs)')
 
     parser.add_argument('-c', '--useclaude', action='store_true', default=False, help='specify if you want to use calude3')
     parser.add_argument('-g', '--gpt', action='store', default="openai", help='specify openai or calude3 or openaicompatible')
@@ -328,55 +1235,152 @@ if __name__=="__main__":
     parser.add_argument('-y', '--secretkey', action='store', default=os.getenv("AWS_SECRET_ACCESS_KEY"), help='specify your secret key or set it in AWS_SECRET_ACCESS_KEY env (for claude3)')
     parser.add_argument('-e', '--endpoint', action='store', default=None, help='specify your end point or set it in AZURE_OPENAI_ENDPOINT env')
     parser.add_argument('-d', '--deployment', action='store', default=None, help='specify deployment name or set it in AZURE_OPENAI_DEPLOYMENT_NAME env')
+    parser.add_argument('--poolsize', action='store', default=None, type=int, help='specify max number of keep-alive connections to the LLM endpoint')
+    parser.add_argument('--timeout', action='store', default=None, type=float, help='specify read timeout (sec) of the LLM query')
+    parser.add_argument('--maxretry', action='store', default=3, type=int, help='specify max number of tries of the LLM query')
+    parser.add_argument('--rpm', action='store', default=None, type=int, help='specify requests per minute budget of the LLM endpoint')
+    parser.add_argument('--tpm', action='store', default=None, type=int, help='specify (estimated) tokens per minute budget of the LLM endpoint')
 
     parser.add_argument('--reset', action='store_true', default=False, help='specify if you want to reset cache')
-
+    parser.add_argument('--cachebackend', action='store', default="json", help='specify json (a file per entry) or sqlite (single file, existing json cache is migrated)')
+    parser.add_argument('--maxcache', action='store', default=None, type=int, help='specify max number of cache entries (least recently used ones are evicted)')
+    parser.add_argument('--maxcachebytes', action='store', default=None, type=int, help='specify max total bytes of cache entries (least recently used ones are evicted)')
+
+    parser.add_argument('--diff', action='store_true', default=False, help='specify if you want LLM to output unified diff instead of the whole resolved code')
+    parser.add_argument('--fullcode', action='store_true', default=False, help='specify if you want to output the resolved code rebuilt from the diff (with --diff)')
+    parser.add_argument('--similarity', action='store_true', default=False, help='specify if you want to reuse the cached resolution of the near-identical snippet (e.g. moved or reformatted file)')
+    parser.add_argument('--simdistance', action='store', default=SimilarityIndex.DEFAULT_MAX_DISTANCE, type=int, help='specify max hamming distance (0-3) of the 64bit SimHash to reuse the resolution (with --similarity)')
+    parser.add_argument('--simmintokens', action='store', default=SimilarityIndex.DEFAULT_MIN_TOKENS, type=int, help='specify min number of tokens of the snippet to use the similarity (with --similarity)')
+    parser.add_argument('--localrules', action='store_true', default=False, help='specify if you want to resolve known mechanical findings e.g. passedByValue, missingOverride by the local rules without LLM')
+    parser.add_argument('--batch', action='store_true', default=False, help='specify if you want to resolve findings in overlapping windows with one query')
     parser.add_argument('--onlynew', action='store_true', default=False, help='specify if you want to report newly found resolution (cache misshit)')
+    parser.add_argument('--base', action='store', default=None, help='specify the base git revision to resolve only the findings in the changed lines since it (e.g. origin/main)')
+    parser.add_argument('--offlinebatch', action='store', default=None, help='specify the path of the offline batch jsonl. the prompts of the cache misses are written to it instead of querying LLM (phase 1)')
+    parser.add_argument('--offlineresults', action='store', default=None, help='specify the path of the offline batch results jsonl to store them to the cache (phase 2, with --offlinebatch)')
+    parser.add_argument('--journal', action='store', default=None, help='specify the path of the run journal (jsonl) to record the targets, the findings and the completed outputs')
+    parser.add_argument('--resume', action='store_true', default=False, help='specify if you want to resume the run from the first unfinished target recorded in --journal')
+    parser.add_argument('--stream', action='store_true', default=False, help='specify if you want to resolve findings while CppChecker is running')
+    parser.add_argument('--serve', action='store', default=None, help='specify the unix socket path to run as the resolver server. the LLM client and the cache are kept warm across the requests')
+    parser.add_argument('--connect', action='store', default=None, help='specify the unix socket path of the running resolver server (--serve) to resolve the targets on it')
+    parser.add_argument('--memorycache', action='store', default=None, type=int, help='specify max number of cache entries kept in memory (default:65536 with --serve)')
+    parser.add_argument('--queryttl', action='store', default=3600, type=int, help='specify seconds to share the completed LLM query with the identical ones of the later requests with --serve (default:3600)')
 
     args = parser.parse_args()
-
-    gpt_client = GptClientFactory.new_client(args)
-    llm_resolver = CppCheckerResolverWithLLM(gpt_client)
-    resolver = CppCheckerResolver(llm_resolver)
+    if args.resume and not args.journal:
+        parser.error("--resume requires --journal")
+    if args.serve and (args.journal or args.offlinebatch):
+        parser.error("--serve can't be used with --journal or --offlinebatch")
+
+    if args.connect:
+        # the targets are resolved by the running server. relative paths are resolved here since the server's cwd differs
+        target_paths = [target_path if ":" in target_path else os.path.abspath(os.path.expanduser(target_path)) for target_path in TargetReader.expand_target_paths(args.args)]
+        try:
+            num_of_errors = ResolverClient(args.connect).execute(target_paths, args.onlynew, args.fullcode)
+        except OSError as e:
+            print(f"ERROR!!!: can't connect to the resolver server {args.connect} ({e})", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(1 if num_of_errors else 0)
+
+    SourceFileIndex.get_shared().max_bytes = args.maxsourcebytes
+    gpt_client = GptClientFactory.new_lazy_client(args)
+    rate_controller = RateController(args.maxretry, args.rpm, args.tpm, max(args.jobs, args.maxllmcalls if args.maxllmcalls else 1))
+    if args.diff:
+        llm_resolver = CppCheckerDiffResolverWithLLM(gpt_client, None, rate_controller)
+    else:
+        llm_resolver = CppCheckerResolverWithLLM(gpt_client, None, rate_controller)
+    batch_resolver = CppCheckerBatchResolverWithLLM(gpt_client, None, rate_controller) if args.batch else None
+    local_resolver = CppCheckRules.new_registry() if args.localrules else None
+    similarity_index = SimilarityIndex(os.path.join(JsonCache.DEFAULT_CACHE_BASE_DIR, CppCheckerResolver.CACHE_ID), args.simdistance, args.simmintokens) if args.similarity else None
+    offline_batch = None
+    if args.offlinebatch and not args.offlineresults:
+        offline_batch = OfflineBatchWriter(args.offlinebatch, args.deployment if args.deployment else os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"))
+    context_extractor = CodeContextExtractor(args.tokenbudget, args.marginline) if args.scopecontext else None
+    memory_cache_entries = args.memorycache if args.memorycache!=None or not args.serve else 65536
+    resolver = CppCheckerResolver(llm_resolver, args.marginline, args.jobs, args.cachebackend, args.maxcache, args.maxcachebytes, args.maxllmcalls, batch_resolver, local_resolver, similarity_index, offline_batch, context_extractor, memory_cache_entries)
     if args.reset:
         resolver.reset_cache()
 
-    cppchecker = CppCheckerUtil(args.cppcheck)
-    target_paths = []
-    for target_path in args.args:
-        if ":" in target_path:
-            _paths = target_path.split(":")
-            target_path = os.path.abspath(os.path.expanduser(_paths[0].strip())).strip()
-            report_path = os.path.abspath(os.path.expanduser(_paths[1].strip())).strip()
-            if report_path.endswith("summary.md"):
-                summary = SummaryReader(report_path, target_path)
-                reports = summary.parse()
-                for report in reports:
-                    target_paths.append(os.path.join(target_path, report["path"])+":"+report["report_path"])
-            else:
-                target_paths.append(target_path+":"+report_path)
-        else:
-            target_paths.append(target_path)
+    if args.offlineresults:
+        # phase 2 of the offline batch
+        if not args.offlinebatch:
+            parser.error("--offlineresults requires --offlinebatch")
+        stored, failed = resolver.ingest_offline_results(args.offlineresults, OfflineBatchWriter.get_manifest_path(args.offlinebatch))
+        print(f"{stored} findings stored to the cache from the offline batch results, {failed} findings failed", file=sys.stderr)
+        if not args.args:
+            resolver.shutdown()
+            sys.exit(0)
 
-    for target_path in target_paths:
-        results = {}
-        if ":" in target_path:
-            _paths = target_path.split(":")
-            target_path = _paths[0]
-            report_path = _paths[1]
-            results = cppchecker.existing_summary_reader(report_path)
-        else:
-            results = cppchecker.execute(target_path)
-        for filename, reports in results.items():
-            resolved_outputs = resolver.execute(target_path, filename, reports, args.onlynew)
-            resolved_outputs = sorted(resolved_outputs, key=lambda x: (x["filename"], x["pos"]))
-            if resolved_outputs:
-                print(f"# {filename}")
-                print("")
-                for resolved_output in resolved_outputs:
-                    _resolved = resolved_output["message"].split("\n")[0]
-                    print(f"## {_resolved} (line:{resolved_output['pos']})")
-                    #print(f"## {resolved_output["message"].split("\n")[0]} (line:{resolved_output["pos"]})")
-                    print("")
-                    print(resolved_output["resolution"])
-                    print("")
+    cppchecker = CppCheckerUtil(args.cppcheck)
+    cppcheck_xml = CppCheckXmlUtil(args.cppcheckbin, args.cppcheckjobs, args.cppcheckoptions)
+    if args.usecppcheck:
+        cppchecker = cppcheck_xml
+    journal = RunJournal(args.journal, args.resume) if args.journal else None
+    target_paths = journal.get_targets() if journal and journal.get_targets()!=None else None
+    if target_paths==None:
+        target_paths = TargetReader.expand_target_paths(args.args)
+        if journal:
+            journal.put_targets(target_paths)
+
+    incremental_filter = GitIncrementalFilter(args.base) if args.base else None
+    target_reader = TargetReader(cppchecker, cppcheck_xml, args.stream, incremental_filter)
+    if journal:
+        target_reader = JournaledTargetReader(target_reader, journal)
+    if args.serve:
+        # the identical queries across the requests (e.g. the same header from the parallel jobs) are still deduplicated for a while
+        resolver.query_ttl = args.queryttl
+        def process(target_path, is_only_new, is_full_code, out):
+            # the file tree and the git changes may be changed since the last request
+            DirectoryTreeIndex.reset()
+            _target_reader = TargetReader(cppchecker, cppcheck_xml, args.stream, GitIncrementalFilter(args.base) if args.base else None)
+            stats = ResolverStats(os.path.basename(os.path.normpath(target_path.split(":")[0])))
+            ModuleScheduler(_target_reader, resolver, is_only_new, 1, is_full_code).write_target(target_path, stats, out, max(args.jobs, 1) * 16)
+            return ModuleScheduler.get_stats_text(stats)
+        def on_terminate(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, on_terminate)
+        print(f"serving on {args.serve}", file=sys.stderr)
+        exit_code = 0
+        try:
+            ResolverServer(args.serve, process, args.modulejobs).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            print(f"ERROR!!!: can't serve on {args.serve} ({e})", file=sys.stderr)
+            exit_code = 1
+        resolver.shutdown()
+        sys.exit(exit_code)
+    if args.modulejobs>1:
+        scheduler = ModuleScheduler(target_reader, resolver, args.onlynew, args.modulejobs, args.fullcode, journal)
+        scheduler.execute(target_paths)
+        scheduler.print_summary()
+    else:
+        # dispatch findings across the targets and output them in the same order as the targets
+        out = JournalOutput(sys.stdout) if journal else None
+        writer = ResolvedOutputWriter(resolver, max(args.jobs, 1) * 16, out, args.fullcode)
+        for target_path in target_paths:
+            if journal and journal.is_done(target_path):
+                # completed in the previous run
+                writer.flush()
+                sys.stdout.write( journal.get_output(target_path) )
+                sys.stdout.flush()
+                continue
+            base_path, results = target_reader.read(target_path)
+            for filename, reports in results:
+                writer.add(filename, resolver.submit(base_path, filename, reports, args.onlynew), base_path)
+            if journal:
+                writer.add_callback(lambda target_path=target_path: journal.put_done(target_path, out.take()))
+        writer.flush()
+
+    if offline_batch:
+        offline_batch.close()
+        print(f"{offline_batch.num_of_findings} findings ({len(offline_batch.custom_ids)} requests) written to {args.offlinebatch}", file=sys.stderr)
+    if incremental_filter:
+        print(f"{incremental_filter.accepted} findings in the changed lines since {args.base}, {incremental_filter.skipped} findings skipped", file=sys.stderr)
+    if resolver.stats.get('deduplicated'):
+        deduplicated = resolver.stats.get('deduplicated')
+        print(f"{deduplicated} duplicated findings shared the LLM responses (dedup ratio {deduplicated/(deduplicated+resolver.stats.get('queried_findings')):.1%})", file=sys.stderr)
+    if similarity_index:
+        print(f"{resolver.stats.get('similar_reused')} findings reused the resolutions of the similar snippets", file=sys.stderr)
+    if local_resolver:
+        print(f"{resolver.stats.get('rule_resolved')} findings resolved by the local rules ({resolver.stats.get('rule_resolved')} LLM calls avoided)", file=sys.stderr)
+    resolver.shutdown()
@@ -0,0 +1,89 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+
+class DiffUtil:
+    HUNK_HEADER = re.compile(r'^@@\s*-(\d+)(?:,(\d+))?\s+\+(\d+)(?:,(\d+))?\s*@@')
+
+    @staticmethod
+    def extract_diff(text):
+        # the unified diff in ```diff ... ``` (or the text itself)
+        text = str(text)
+        pos1 = text.find("```")
+        if pos1!=-1:
+            pos2 = text.find("\n", pos1)
+            pos3 = text.find("```", pos2)
+            if pos2!=-1:
+                text = text[pos2+1:pos3] if pos3!=-1 else text[pos2+1:]
+        lines = text.splitlines()
+        for i, line in enumerate(lines):
+            if line.startswith("@@"):
+                return "\n".join(lines[i:])
+        return None
+
+    @staticmethod
+    def parse_hunks(diff_text):
+        # returns [(old_start, [(tag, line)])]. tag is " ", "-" or "+". old_start is None if the header lacks it
+        hunks = []
+        for line in diff_text.splitlines():
+            if line.startswith("@@"):
+                m = DiffUtil.HUNK_HEADER.match(line)
+                hunks.append( (int(m.group(1)) if m else None, []) )
+            elif hunks and not line.startswith(("---", "+++", "\\")):
+                tag = line[0:1]
+                if tag in ["-", "+", " "]:
+                    hunks[-1][1].append( (tag, line[1:]) )
+                elif not line:
+                    # some models drop the space of the empty context line
+                    hunks[-1][1].append( (" ", "") )
+        return hunks
+
+    @staticmethod
+    def find_hunk_pos(lines, old_lines, expected_pos, start_pos):
+        # the nearest position to expected_pos where old_lines match. whitespaces at the end of lines are ignored
+        candidates = range(start_pos, len(lines)-len(old_lines)+1)
+        for pos in sorted(candidates, key=lambda pos: abs(pos-expected_pos)):
+            is_match = True
+            for i, old_line in enumerate(old_lines):
+                if lines[pos+i].rstrip()!=old_line.rstrip():
+                    is_match = False
+                    break
+            if is_match:
+                return pos
+        return None
+
+    @staticmethod
+    def apply(lines, diff_text):
+        # returns the patched lines or None if the diff doesn't apply to the lines
+        if not diff_text:
+            return None
+        hunks = DiffUtil.parse_hunks(diff_text)
+        if not hunks:
+            return None
+
+        result = []
+        pos = 0
+        for old_start, hunk_lines in hunks:
+            old_lines = [line for tag, line in hunk_lines if tag!="+"]
+            new_lines = [line for tag, line in hunk_lines if tag!="-"]
+            expected_pos = old_start-1 if old_start else pos
+            hunk_pos = DiffUtil.find_hunk_pos(lines, old_lines, max(expected_pos, pos), pos)
+            if hunk_pos==None:
+                return None
+            result.extend(lines[pos:hunk_pos])
+            result.extend(new_lines)
+            pos = hunk_pos + len(old_lines)
+        result.extend(lines[pos:])
+        return result
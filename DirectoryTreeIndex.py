@@ -0,0 +1,100 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import threading
+import time
+
+class DirectoryTreeIndex:
+    # file names of the directories under the root listed by os.scandir once per directory.
+    # a missing file re-checks the directory's mtime (at most once per RECHECK_INTERVAL) and the directory is listed again if it's changed
+    RECHECK_INTERVAL = 1.0
+    indexes = {}
+    indexes_lock = threading.Lock()
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.lock = threading.Lock()
+        # relative directory -> [mtime, set of file names, last checked time]
+        self.dirs = {}
+        # filenames as given which are found already. a found file is kept as found during the run
+        self.found = set()
+
+    @staticmethod
+    def get_index(root):
+        # memoized per run
+        root = os.path.abspath(root)
+        with DirectoryTreeIndex.indexes_lock:
+            index = DirectoryTreeIndex.indexes.get(root)
+            if index == None:
+                index = DirectoryTreeIndex(root)
+                DirectoryTreeIndex.indexes[root] = index
+            return index
+
+    @staticmethod
+    def reset():
+        # forget the indexes e.g. for the next request of the long running server
+        with DirectoryTreeIndex.indexes_lock:
+            DirectoryTreeIndex.indexes = {}
+
+    def scan(self, dir_path):
+        mtime = None
+        files = set()
+        try:
+            mtime = os.stat(dir_path).st_mtime
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.is_file():
+                        files.add(entry.name)
+        except OSError:
+            pass
+        return mtime, files
+
+    def get_mtime(self, dir_path):
+        try:
+            return os.stat(dir_path).st_mtime
+        except OSError:
+            return None
+
+    def exists(self, filename):
+        # same as os.path.exists(os.path.join(root, filename)) for the files
+        if filename in self.found:
+            return True
+        path = os.path.normpath(filename)
+        if os.path.isabs(path) or path.startswith(".."):
+            return os.path.exists(os.path.join(self.root, path))
+        rel_dir, name = os.path.split(path)
+        dir_path = os.path.join(self.root, rel_dir)
+        with self.lock:
+            entry = self.dirs.get(rel_dir)
+        if entry == None:
+            mtime, files = self.scan(dir_path)
+            entry = [mtime, files, time.monotonic()]
+            with self.lock:
+                self.dirs[rel_dir] = entry
+        if name in entry[1]:
+            self.found.add(filename)
+            return True
+        now = time.monotonic()
+        if now - entry[2] >= self.RECHECK_INTERVAL:
+            # the directory may be changed after the scan
+            entry[2] = now
+            if self.get_mtime(dir_path) != entry[0]:
+                mtime, files = self.scan(dir_path)
+                with self.lock:
+                    self.dirs[rel_dir] = [mtime, files, now]
+                if name in files:
+                    self.found.add(filename)
+                    return True
+        return False
@@ -77,4 +77,26 @@ class ExecUtil:
                     result.append(aLine)
             except subprocess.CalledProcessError:
                 pass
-        return result
\ No newline at end of file
+        return result
+
+    @staticmethod
+    def getExecResultEachLineStream(command, execPath=".", enableStderr=True, enableStrip=True):
+        # generator version of getExecResultEachLine. yields each line while the command is running
+        if os.path.isdir(execPath):
+            exec_cmd = command
+            if enableStderr and " 2>" not in exec_cmd:
+                exec_cmd += " 2>&1"
+            proc = subprocess.Popen(exec_cmd, shell=True, cwd=execPath, stdout=subprocess.PIPE)
+            try:
+                for aLine in proc.stdout:
+                    aLine = aLine.decode('utf-8', errors='replace')
+                    if enableStrip:
+                        aLine = aLine.strip()
+                    else:
+                        aLine = aLine.rstrip("\r\n")
+                    yield aLine
+            finally:
+                proc.stdout.close()
+                if proc.poll() == None:
+                    proc.kill()
+                proc.wait()
@@ -0,0 +1,109 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from array import array
+from collections.abc import Mapping
+
+class FileReports(Mapping):
+    # read only view of the findings of a file : {line_number: {message_id: [message]}}.
+    # the per line dicts are built on demand from the columns of the store
+    __slots__ = ("store", "rows")
+
+    def __init__(self, store, rows):
+        self.store = store
+        self.rows = rows
+
+    def iter_lines(self):
+        # yields (line_number, {message_id: [message]}) in the order of the first appearance of the line
+        strings = self.store.strings
+        line_numbers = self.store.line_numbers
+        message_ids = self.store.message_ids
+        messages = self.store.messages
+        lines = {}
+        for row in self.rows:
+            line_reports = lines.get(line_numbers[row])
+            if line_reports == None:
+                line_reports = lines[line_numbers[row]] = {}
+            line_reports.setdefault(strings[message_ids[row]], []).append(strings[messages[row]])
+        return iter(lines.items())
+
+    def items(self):
+        return self.iter_lines()
+
+    def __getitem__(self, line_number):
+        for _line_number, line_reports in self.iter_lines():
+            if _line_number == line_number:
+                return line_reports
+        raise KeyError(line_number)
+
+    def __iter__(self):
+        for line_number, _ in self.iter_lines():
+            yield line_number
+
+    def __len__(self):
+        line_numbers = self.store.line_numbers
+        return len(set(line_numbers[row] for row in self.rows))
+
+
+class FindingStore(Mapping):
+    # compact replacement of {filename: {line_number: {message_id: [message]}}}.
+    # filenames, message ids and messages are interned to a string table and each finding is a row of the array columns
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.line_numbers = array('I')
+        self.message_ids = array('I')
+        self.messages = array('I')
+        # filename id -> rows of the file. ordered by the first appearance of the file
+        self.file_rows = {}
+
+    def intern(self, text):
+        string_id = self.string_ids.get(text)
+        if string_id == None:
+            string_id = len(self.strings)
+            self.strings.append(text)
+            self.string_ids[text] = string_id
+        return string_id
+
+    def add(self, filename, line_number, message_id, message):
+        row = len(self.line_numbers)
+        self.line_numbers.append(line_number)
+        self.message_ids.append(self.intern(message_id))
+        self.messages.append(self.intern(message))
+        file_id = self.intern(filename)
+        rows = self.file_rows.get(file_id)
+        if rows == None:
+            rows = self.file_rows[file_id] = array('I')
+        rows.append(row)
+
+    def get_num_of_findings(self):
+        return len(self.line_numbers)
+
+    def items(self):
+        # yields (filename, FileReports) grouped by file
+        for file_id, rows in self.file_rows.items():
+            yield self.strings[file_id], FileReports(self, rows)
+
+    def __getitem__(self, filename):
+        file_id = self.string_ids.get(filename)
+        if file_id == None or not file_id in self.file_rows:
+            raise KeyError(filename)
+        return FileReports(self, self.file_rows[file_id])
+
+    def __iter__(self):
+        for file_id in self.file_rows.keys():
+            yield self.strings[file_id]
+
+    def __len__(self):
+        return len(self.file_rows)
@@ -0,0 +1,127 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import re
+import shlex
+import threading
+from ExecUtil import ExecUtil
+from DirectoryTreeIndex import DirectoryTreeIndex
+
+class GitUtil:
+    HUNK_HEADER = re.compile(r'^@@\s*-\d+(?:,\d+)?\s+\+(\d+)(?:,(\d+))?\s*@@')
+
+    @staticmethod
+    def get_merge_base(target_path, base):
+        lines = ExecUtil.getExecResultEachLine(f'git merge-base {shlex.quote(base)} HEAD 2>/dev/null', target_path)
+        return lines[0] if lines else None
+
+    @staticmethod
+    def parse_diff_hunks(lines):
+        # returns {filename: [(start_line, end_line)]} of the new side of "git diff -U0"
+        result = {}
+        filename = None
+        for line in lines:
+            if line.startswith("+++ "):
+                filename = line[4:]
+                if filename.startswith("b/"):
+                    filename = filename[2:]
+                elif filename=="/dev/null":
+                    filename = None
+            elif filename and line.startswith("@@"):
+                m = GitUtil.HUNK_HEADER.match(line)
+                if m:
+                    start_line = int(m.group(1))
+                    count = int(m.group(2)) if m.group(2)!=None else 1
+                    if count==0:
+                        # deletion only : the lines around the deleted position are touched
+                        result.setdefault(filename, []).append( (max(start_line, 1), start_line+1) )
+                    else:
+                        result.setdefault(filename, []).append( (start_line, start_line+count-1) )
+        return result
+
+    @staticmethod
+    def get_changed_hunks(target_path, base):
+        # changed lines in the target_path since base (incl. the uncommitted changes). filenames are relative to target_path
+        # the changed sources may have non utf-8 bytes (e.g. latin-1 or shift_jis comments) then the lines are decoded with replacement
+        lines = ExecUtil.getExecResultEachLineStream(f'git diff -U0 --no-color --no-ext-diff --relative {shlex.quote(base)} -- . 2>/dev/null', target_path, False, False)
+        return GitUtil.parse_diff_hunks(lines)
+
+    @staticmethod
+    def get_commit_ids(target_path, base):
+        # commits after base
+        return ExecUtil.getExecResultEachLine(f'git rev-list {shlex.quote(base)}..HEAD 2>/dev/null', target_path)
+
+
+class GitIncrementalFilter:
+    # limits the findings to the ones in the changed hunks since the base revision
+    COMMIT_ID = re.compile(r'^[0-9a-fA-F]{7,40}$')
+    # cppcheck checks the explicitly specified files whatever the extension is, then the others (docs, scripts, build files) are excluded
+    SOURCE_EXTENSIONS = (".c", ".cc", ".cpp", ".cxx", ".c++", ".h", ".hh", ".hpp", ".hxx", ".h++", ".ipp", ".ixx", ".tpp", ".txx", ".inl")
+
+    def __init__(self, base):
+        self.base = base
+        self.lock = threading.Lock()
+        self.changes = {}
+        self.accepted = 0
+        self.skipped = 0
+
+    def get_changes(self, target_path):
+        # (hunks, commit ids) of the target_path. memoized since the same target is queried per finding
+        target_path = os.path.abspath(target_path)
+        with self.lock:
+            if target_path in self.changes:
+                return self.changes[target_path]
+        base = GitUtil.get_merge_base(target_path, self.base) or self.base
+        hunks = GitUtil.get_changed_hunks(target_path, base)
+        commit_ids = [commit_id.lower() for commit_id in GitUtil.get_commit_ids(target_path, base)]
+        with self.lock:
+            self.changes[target_path] = (hunks, commit_ids)
+        return hunks, commit_ids
+
+    def get_changed_files(self, target_path):
+        # the changed C/C++ sources and headers which exist
+        hunks, _ = self.get_changes(target_path)
+        tree_index = DirectoryTreeIndex.get_index(target_path)
+        return [filename for filename in hunks.keys() if filename.lower().endswith(self.SOURCE_EXTENSIONS) and tree_index.exists(filename)]
+
+    def is_new_commit(self, commit_id, commit_ids):
+        # unknown commit id (e.g. not committed yet) is regarded as new
+        if not commit_id or not self.COMMIT_ID.match(commit_id) or not commit_id.strip("0"):
+            return True
+        commit_id = commit_id.lower()
+        for _commit_id in commit_ids:
+            if _commit_id.startswith(commit_id):
+                return True
+        return False
+
+    def is_in_hunks(self, line_number, hunks):
+        for start_line, end_line in hunks:
+            if line_number>=start_line and line_number<=end_line:
+                return True
+        return False
+
+    def filter(self, target_path, findings):
+        # yields the findings (filename, line_number, message_id, message, commit_id) which touch the changed hunks
+        hunks, commit_ids = self.get_changes(target_path)
+        for filename, line_number, message_id, message, commit_id in findings:
+            _filename = os.path.normpath(filename)
+            is_target = _filename in hunks and self.is_in_hunks(line_number, hunks[_filename]) and self.is_new_commit(commit_id, commit_ids)
+            with self.lock:
+                if is_target:
+                    self.accepted += 1
+                else:
+                    self.skipped += 1
+            if is_target:
+                yield filename, line_number, message_id, message, commit_id
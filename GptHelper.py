@@ -17,16 +17,99 @@ import os
 import re
 import sys
 import json
-import requests
-from openai import AzureOpenAI
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
 import logging
-import boto3
-from botocore.exceptions import ClientError
+# the SDKs of the backends (openai, requests, boto3) are imported when the client of the backend is created
+
+class GptQueryError(Exception):
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @staticmethod
+    def parse_retry_after(value):
+        # Retry-After: <seconds> or <http-date>
+        if value:
+            try:
+                return max(float(value), 0)
+            except:
+                try:
+                    return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+                except:
+                    pass
+        return None
+
+    @staticmethod
+    def from_response(status_code, text, headers={}):
+        return GptQueryError(f"Error: {status_code} - {text}", status_code, GptQueryError.parse_retry_after(headers.get("Retry-After")))
+
+
+class StreamStopCondition:
+    # decides when the streamed output is enough to cancel the rest of the stream
+    #   * stop_sequences : stop at (and trim) any of them. also sent to the API as stop sequences
+    #   * code_blocks : stop when the specified number of ``` blocks are closed
+    #   * max_output_tokens : stop at the (estimated) output budget. also sent to the API as max tokens
+    CODE_FENCE = "```"
+
+    def __init__(self, stop_sequences=None, code_blocks=None, max_output_tokens=None):
+        self.stop_sequences = stop_sequences if stop_sequences else []
+        self.code_blocks = code_blocks
+        self.max_output_tokens = max_output_tokens
+        self.num_fences = 0
+        self.scanned_pos = 0
+        self.is_stopped = False
+
+    def is_done(self, output):
+        # called with the whole output so far on each chunk
+        if self.max_output_tokens and len(output) >= self.max_output_tokens * 4:
+            self.is_stopped = True
+        for stop_sequence in self.stop_sequences:
+            if stop_sequence in output[max(self.scanned_pos-len(stop_sequence), 0):]:
+                self.is_stopped = True
+        if self.code_blocks:
+            pos = output.find(self.CODE_FENCE, max(self.scanned_pos-len(self.CODE_FENCE)+1, 0))
+            while pos!=-1:
+                self.num_fences += 1
+                pos = output.find(self.CODE_FENCE, pos+len(self.CODE_FENCE))
+            if self.num_fences >= self.code_blocks * 2:
+                self.is_stopped = True
+        self.scanned_pos = len(output)
+        return self.is_stopped
+
+    def trim(self, output):
+        for stop_sequence in self.stop_sequences:
+            pos = output.find(stop_sequence)
+            if pos!=-1:
+                output = output[:pos]
+        if self.code_blocks and self.num_fences >= self.code_blocks * 2:
+            # drop the prose after the last closed code block
+            pos = -1
+            for _ in range(self.code_blocks * 2):
+                pos = output.find(self.CODE_FENCE, pos+1)
+                if pos==-1:
+                    break
+            if pos!=-1:
+                output = output[:pos+len(self.CODE_FENCE)]
+        return output.rstrip()
+
 
 class IGpt:
-    def query(self, system_prompt, user_prompt):
+    def query(self, system_prompt, user_prompt, stop_condition=None):
         return None, None
 
+    async def query_async(self, system_prompt, user_prompt, stop_condition=None):
+        # default : run the blocking query on the default executor. override this for the native async client
+        return await asyncio.to_thread(self.query, system_prompt, user_prompt, stop_condition)
+
+    async def close_async(self):
+        # releases the resources of query_async() bound to the running event loop
+        pass
+
     @staticmethod
     def add_code_section(the_flatten_lines, path=None):
         if path==None or path.endswith(('.cpp', '.c', '.cxx', '.h', 'hpp', '.hxx', '.py', '.asm', '.java', '.rs', '.kt', '.rb')):
@@ -85,47 +168,100 @@ class IGpt:
 
 
 class OpenAIGptHelper(IGpt):
-    def __init__(self, api_key, endpoint, api_version = "2024-02-01", model = "gpt-35-turbo-instruct"):
+    def __init__(self, api_key, endpoint, api_version = "2024-02-01", model = "gpt-35-turbo-instruct", pool_size=None, timeout=None):
+        from openai import AzureOpenAI
+        options = {}
+        if pool_size or timeout:
+            # httpx is the transport of the openai SDK
+            import httpx
+            if pool_size:
+                options["http_client"] = httpx.Client(limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+            if timeout:
+                connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+                options["timeout"] = httpx.Timeout(read_timeout, connect=connect_timeout)
         self.client = AzureOpenAI(
           api_key = api_key,
           api_version = api_version,
-          azure_endpoint = endpoint
+          azure_endpoint = endpoint,
+          **options
         )
         self.model = model
 
-    def query(self, system_prompt, user_prompt):
+    def query(self, system_prompt, user_prompt, stop_condition=None):
         _messages = []
         if system_prompt:
             _messages.append( {"role": "system", "content": system_prompt} )
         if user_prompt:
             _messages.append( {"role": "user", "content": user_prompt} )
 
+        options = {}
+        if stop_condition:
+            if stop_condition.stop_sequences:
+                options["stop"] = stop_condition.stop_sequences[0:4]
+            if stop_condition.max_output_tokens:
+                options["max_tokens"] = stop_condition.max_output_tokens
+
         response = self.client.chat.completions.create(
             model= self.model,
-            messages = _messages
+            messages = _messages,
+            **options
         )
-        return response.choices[0].message.content, response
+        content = response.choices[0].message.content
+        if stop_condition and isinstance(content, str):
+            # the stop sequence isn't always honored and the prose after the code block is returned
+            stop_condition.is_done(content)
+            content = stop_condition.trim(content)
+        return content, response
 
 
 class OpenAICompatibleGptHelper(IGpt):
-    def __init__(self, api_key, endpoint, model=None, is_streaming = False, headers={}):
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_TIMEOUT = (10, 600) # (connect, read) seconds
+
+    def __init__(self, api_key, endpoint, model=None, is_streaming = False, headers={}, pool_size=None, timeout=None):
         self.api_key = api_key
         self.endpoint = endpoint
         self.model = model
         self.is_streaming = is_streaming
-        self.headers = headers
+        self.headers = dict(headers)
         self.headers['accept'] = 'application/json'
         self.headers['Content-Type'] = 'application/json'
         if self.api_key:
             self.headers['Authorization'] = f'Bearer {self.api_key}'
-
-    def _create_payload(self, messages):
+        self.pool_size = pool_size if pool_size else self.DEFAULT_POOL_SIZE
+        self.timeout = timeout if timeout else self.DEFAULT_TIMEOUT
+
+        # keep-alive connections are reused across the queries
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.async_sessions = {}
+
+    def _create_payload(self, messages, stop_condition=None):
         # payload
         payload = {
             "messages": messages,
         }
         if self.is_streaming:
             payload["stream"] = True
+        if stop_condition:
+            if self.is_streaming:
+                # ollama
+                options = {}
+                if stop_condition.stop_sequences:
+                    options["stop"] = stop_condition.stop_sequences
+                if stop_condition.max_output_tokens:
+                    options["num_predict"] = stop_condition.max_output_tokens
+                if options:
+                    payload["options"] = options
+            else:
+                if stop_condition.stop_sequences:
+                    payload["stop"] = stop_condition.stop_sequences[0:4]
+                if stop_condition.max_output_tokens:
+                    payload["max_tokens"] = stop_condition.max_output_tokens
         if self.model:
             models = self.model.split(",")
             if len(models)==1:
@@ -135,70 +271,156 @@ class OpenAICompatibleGptHelper(IGpt):
 
         return payload
 
-    def query(self, system_prompt, user_prompt):
+    def _create_messages(self, system_prompt, user_prompt):
         _messages = []
         if system_prompt:
             _messages.append( {"role": "system", "content": system_prompt} )
         if user_prompt:
             _messages.append( {"role": "user", "content": user_prompt} )
-
-        payload  = self._create_payload(_messages)
+        return _messages
+
+    def _parse_streaming_line(self, line, output):
+        # returns (output, message). message is set when the stream is done
+        body = json.loads(line)
+        if "error" in body:
+            raise Exception(body["error"])
+        if body.get("done") is False:
+            message = body.get("message", "")
+            content = message.get("content", "")
+            output += content
+
+        if body.get("done", False):
+            message = body
+            message["content"] = output
+            return output, message
+        return output, None
+
+    def _trim_response(self, result, stop_condition):
+        main_messages, response_json = result
+        if stop_condition and isinstance(main_messages, str):
+            stop_condition.is_done(main_messages)
+            main_messages = stop_condition.trim(main_messages)
+        return main_messages, response_json
+
+    def _parse_response(self, response_json):
+        responses = response_json
+        if isinstance(responses, dict):
+            responses = [responses]
+        main_messages = []
+        for a_response in responses:
+            main_messages.append( a_response['choices'][0]['message']['content'] )
+        if len(main_messages)==1:
+            main_messages = main_messages[0]
+        return main_messages, response_json
+
+    def query(self, system_prompt, user_prompt, stop_condition=None):
+        payload  = self._create_payload( self._create_messages(system_prompt, user_prompt), stop_condition )
         #print(payload)
 
         if self.is_streaming:
             # streaming mode (ollama mode)
-            r = requests.post(self.endpoint, headers=self.headers, json=payload, stream=True)
-            r.raise_for_status()
-            output = ""
-            for line in r.iter_lines():
-                body = json.loads(line)
-                if "error" in body:
-                    raise Exception(body["error"])
-                if body.get("done") is False:
-                    message = body.get("message", "")
-                    content = message.get("content", "")
-                    output += content
-
-                if body.get("done", False):
-                    message = body
-                    message["content"] = output
-                    return output, message
+            with self.session.post(self.endpoint, headers=self.headers, json=payload, stream=True, timeout=self.timeout) as r:
+                if r.status_code != 200:
+                    raise GptQueryError.from_response(r.status_code, r.text, r.headers)
+                output = ""
+                for line in r.iter_lines():
+                    if line:
+                        output, message = self._parse_streaming_line(line, output)
+                        if message:
+                            return output, message
+                        if stop_condition and stop_condition.is_done(output):
+                            # cancel the rest of the stream. the connection is closed by the with statement
+                            output = stop_condition.trim(output)
+                            return output, {"done": True, "done_reason": "stop_condition", "content": output}
 
         else:
             # non-streaming mode
-            response = requests.post(self.endpoint, headers=self.headers, json=payload)
+            response = self.session.post(self.endpoint, headers=self.headers, json=payload, timeout=self.timeout)
             if response.status_code == 200:
-                responses = response_json = response.json()
-                if isinstance(responses, dict):
-                    responses = [responses]
-                main_messages = []
-                for a_response in responses:
-                    main_messages.append( a_response['choices'][0]['message']['content'] )
-                if len(main_messages)==1:
-                    main_messages = main_messages[0]
-                return main_messages, response_json
+                return self._trim_response(self._parse_response(response.json()), stop_condition)
             else:
-                raise Exception(f"Error: {response.status_code} - {response.text}")
+                raise GptQueryError.from_response(response.status_code, response.text, response.headers)
 
         return None, None
 
+    def _get_async_session(self, aiohttp):
+        # aiohttp session is bound to the running event loop. the sessions of the finished loops can't be used any more
+        loop = asyncio.get_running_loop()
+        for _loop in [_loop for _loop in self.async_sessions.keys() if _loop.is_closed()]:
+            del self.async_sessions[_loop]
+        session = self.async_sessions.get(loop)
+        if session==None or session.closed:
+            connect_timeout, read_timeout = self.timeout if isinstance(self.timeout, tuple) else (self.timeout, self.timeout)
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+            )
+            self.async_sessions[loop] = session
+        return session
+
+    async def query_async(self, system_prompt, user_prompt, stop_condition=None):
+        try:
+            import aiohttp
+        except ImportError:
+            # aiohttp is optional
+            return await super().query_async(system_prompt, user_prompt, stop_condition)
+
+        payload  = self._create_payload( self._create_messages(system_prompt, user_prompt), stop_condition )
+        session = self._get_async_session(aiohttp)
+
+        async with session.post(self.endpoint, headers=self.headers, json=payload) as response:
+            if response.status != 200:
+                raise GptQueryError.from_response(response.status, await response.text(), response.headers)
+            if self.is_streaming:
+                # streaming mode (ollama mode)
+                output = ""
+                async for line in response.content:
+                    line = line.strip()
+                    if line:
+                        output, message = self._parse_streaming_line(line, output)
+                        if message:
+                            return output, message
+                        if stop_condition and stop_condition.is_done(output):
+                            output = stop_condition.trim(output)
+                            return output, {"done": True, "done_reason": "stop_condition", "content": output}
+            else:
+                # non-streaming mode
+                return self._trim_response(self._parse_response(await response.json(content_type=None)), stop_condition)
+
+        return None, None
+
+    async def close_async(self):
+        session = self.async_sessions.pop(asyncio.get_running_loop(), None)
+        if session!=None and not session.closed:
+            await session.close()
+
 
 
 class ClaudeGptHelper(IGpt):
-    def __init__(self, api_key, secret_key, region="us-west-2", model="anthropic.claude-3-sonnet-20240229-v1:0"):
+    def __init__(self, api_key, secret_key, region="us-west-2", model="anthropic.claude-3-sonnet-20240229-v1:0", pool_size=None, timeout=None):
+        import boto3
+        from botocore.config import Config
+        options = {}
+        if pool_size:
+            options["max_pool_connections"] = pool_size
+        if timeout:
+            options["connect_timeout"], options["read_timeout"] = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        config = Config(**options) if options else None
         if api_key and secret_key and region:
             self.client = boto3.client(
                 service_name='bedrock-runtime',
                 aws_access_key_id=api_key,
                 aws_secret_access_key=secret_key,
-                region_name=region
+                region_name=region,
+                config=config
             )
         else:
-            self.client = boto3.client(service_name='bedrock-runtime')
+            self.client = boto3.client(service_name='bedrock-runtime', config=config)
 
         self.model = model
 
-    def query(self, system_prompt, user_prompt, max_tokens=200000):
+    def query(self, system_prompt, user_prompt, stop_condition=None, max_tokens=200000):
+        from botocore.exceptions import ClientError
         if self.client:
             _message = [{
                 "role": "user",
@@ -219,6 +441,11 @@ class ClaudeGptHelper(IGpt):
             }
             if system_prompt:
                 _body["system"] = system_prompt
+            if stop_condition:
+                if stop_condition.stop_sequences:
+                    _body["stop_sequences"] = stop_condition.stop_sequences
+                if stop_condition.max_output_tokens:
+                    _body["max_tokens"] = min(max_tokens, stop_condition.max_output_tokens)
             body = json.dumps(_body)
 
             try:
@@ -230,7 +457,8 @@ class ClaudeGptHelper(IGpt):
                 result = ""
                 status = {}
 
-                for event in response.get("body"):
+                stream = response.get("body")
+                for event in stream:
                     chunk = json.loads(event["chunk"]["bytes"])
 
                     if chunk['type'] == 'message_delta':
@@ -242,51 +470,237 @@ class ClaudeGptHelper(IGpt):
                     if chunk['type'] == 'content_block_delta':
                         if chunk['delta']['type'] == 'text_delta':
                             result += chunk['delta']['text']
+                            if stop_condition and stop_condition.is_done(result):
+                                # cancel the rest of the stream
+                                stream.close()
+                                result = stop_condition.trim(result)
+                                status = {"stop_reason": "stop_condition"}
+                                break
 
                 return result, status
 
             except ClientError as err:
                 message = err.response["Error"]["Message"]
                 print(f"A client error occurred: {message}")
+                # let the caller back off on the throttling
+                raise
         return None, None
 
+class LazyGptClient(IGpt):
+    # creates the actual client on the first query. a run whose findings all hit the cache never loads the backend's SDK
+    def __init__(self, create_client):
+        self.create_client = create_client
+        self.client = None
+        self.is_failed = False
+        self.lock = threading.Lock()
+
+    def get_client(self):
+        with self.lock:
+            if self.client==None and not self.is_failed:
+                try:
+                    self.client = self.create_client()
+                except Exception as err:
+                    self.is_failed = True
+                    print(f"ERROR!!!: failed to create the LLM client ({err})", file=sys.stderr)
+            return self.client
+
+    def query(self, system_prompt, user_prompt, stop_condition=None):
+        client = self.get_client()
+        if not client:
+            return None, None
+        if stop_condition:
+            return client.query(system_prompt, user_prompt, stop_condition)
+        return client.query(system_prompt, user_prompt)
+
+    async def query_async(self, system_prompt, user_prompt, stop_condition=None):
+        client = self.get_client()
+        if not client:
+            return None, None
+        return await client.query_async(system_prompt, user_prompt, stop_condition)
+
+    async def close_async(self):
+        if self.client:
+            await self.client.close_async()
+
+
 class GptClientFactory:
+    # --gpt name -> function(args, pool_size, timeout) which creates the client. unknown names use DEFAULT_PROVIDER
+    providers = {}
+    DEFAULT_PROVIDER = "openai"
+
+    @staticmethod
+    def register(names, create_client):
+        for name in names:
+            GptClientFactory.providers[name] = create_client
+
+    @staticmethod
+    def get_provider_name(args):
+        return "calude3" if args.useclaude else args.gpt
+
     @staticmethod
     def new_client(args):
-        gpt_client = None
-
-        if args.useclaude or args.gpt=="calude3":
-            apikey = os.getenv('AWS_ACCESS_KEY_ID') if not args.apikey else args.apikey
-            endpoint = "us-west-2" if not args.endpoint else args.endpoint
-            deployment = "anthropic.claude-3-sonnet-20240229-v1:0" if not args.deployment else args.deployment
-            secretkey = os.getenv("AWS_SECRET_ACCESS_KEY") if not args.secretkey else args.secretkey
-            gpt_client = ClaudeGptHelper(apikey, secretkey, endpoint, deployment)
-        elif args.gpt=="openaicompatible" or args.gpt=="local" or args.gpt=="others":
-            apikey = os.getenv("LLM_API_KEY") if not args.apikey else args.apikey
-            endpoint = os.getenv("LLM_ENDPOINT") if not args.endpoint else args.endpoint
-            deployment = os.getenv("LLM_DEPLOYMENT_NAME") if not args.deployment else args.deployment
-            is_streaming = True if "/api/chat" in endpoint else False
-            headers = {}
-            if "header" in args:
-                for header in args.header:
-                    pos = header.find(":")
-                    if pos!=None:
-                        headers[header[0:pos]] = header[pos+1:].strip()
-
-            gpt_client = OpenAICompatibleGptHelper(apikey, endpoint, deployment, is_streaming, headers)
-        else:
-            apikey = os.getenv("AZURE_OPENAI_API_KEY") if not args.apikey else args.apikey
-            endpoint = os.getenv("AZURE_OPENAI_ENDPOINT") if not args.endpoint else args.endpoint
-            deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME") if not args.deployment else args.deployment
-            gpt_client = OpenAIGptHelper(apikey, endpoint, "2024-02-01", deployment)
+        pool_size = args.poolsize if "poolsize" in args else None
+        timeout = (10, args.timeout) if "timeout" in args and args.timeout else None
+
+        providers = GptClientFactory.providers
+        create_client = providers.get(GptClientFactory.get_provider_name(args), providers[GptClientFactory.DEFAULT_PROVIDER])
+        return create_client(args, pool_size, timeout)
 
-        return gpt_client
+    @staticmethod
+    def new_lazy_client(args):
+        return LazyGptClient(lambda: GptClientFactory.new_client(args))
 
+    @staticmethod
+    def new_claude_client(args, pool_size, timeout):
+        apikey = os.getenv('AWS_ACCESS_KEY_ID') if not args.apikey else args.apikey
+        endpoint = "us-west-2" if not args.endpoint else args.endpoint
+        deployment = "anthropic.claude-3-sonnet-20240229-v1:0" if not args.deployment else args.deployment
+        secretkey = os.getenv("AWS_SECRET_ACCESS_KEY") if not args.secretkey else args.secretkey
+        return ClaudeGptHelper(apikey, secretkey, endpoint, deployment, pool_size, timeout)
+
+    @staticmethod
+    def new_openai_compatible_client(args, pool_size, timeout):
+        apikey = os.getenv("LLM_API_KEY") if not args.apikey else args.apikey
+        endpoint = os.getenv("LLM_ENDPOINT") if not args.endpoint else args.endpoint
+        deployment = os.getenv("LLM_DEPLOYMENT_NAME") if not args.deployment else args.deployment
+        is_streaming = True if "/api/chat" in endpoint else False
+        headers = {}
+        if "header" in args:
+            for header in args.header:
+                pos = header.find(":")
+                if pos!=None:
+                    headers[header[0:pos]] = header[pos+1:].strip()
+
+        return OpenAICompatibleGptHelper(apikey, endpoint, deployment, is_streaming, headers, pool_size, timeout)
+
+    @staticmethod
+    def new_openai_client(args, pool_size, timeout):
+        apikey = os.getenv("AZURE_OPENAI_API_KEY") if not args.apikey else args.apikey
+        endpoint = os.getenv("AZURE_OPENAI_ENDPOINT") if not args.endpoint else args.endpoint
+        deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME") if not args.deployment else args.deployment
+        return OpenAIGptHelper(apikey, endpoint, "2024-02-01", deployment, pool_size, timeout)
+
+GptClientFactory.register(["calude3"], GptClientFactory.new_claude_client)
+GptClientFactory.register(["openaicompatible", "local", "others"], GptClientFactory.new_openai_compatible_client)
+GptClientFactory.register(["openai"], GptClientFactory.new_openai_client)
+
+
+class RateController:
+    # retry & rate control shared by the queries to the same backend
+    #   * exponential backoff with full jitter, or Retry-After if the backend returns it
+    #   * requests per minute and tokens per minute budgets
+    #   * AIMD concurrency : +1/limit on success, half on throttle
+    THROTTLE_STATUS_CODES = [429, 503, 529]
+    RETRYABLE_STATUS_CODES = [408, 409, 500, 502, 504]
+    THROTTLE_ERROR_CODES = ["ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException", "ModelNotReadyException"]
+
+    def __init__(self, max_retries=3, rpm=None, tpm=None, max_concurrency=64, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max_retries
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.request_budget = float(rpm) if rpm else 0
+        self.token_budget = float(tpm) if tpm else 0
+        self.last_refill = time.monotonic()
+
+    @staticmethod
+    def estimate_tokens(*prompts):
+        return sum([len(prompt) for prompt in prompts if prompt]) // 4 + 1
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.rpm:
+            self.request_budget = min(self.rpm, self.request_budget + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.token_budget = min(self.tpm, self.token_budget + elapsed * self.tpm / 60)
+
+    def _wait_time(self, tokens):
+        # seconds to wait until the budgets allow the request. should be called with the condition
+        wait_time = 0
+        if self.in_flight >= max(int(self.limit), 1):
+            wait_time = 1
+        if self.rpm and self.request_budget < 1:
+            wait_time = max(wait_time, (1 - self.request_budget) * 60 / self.rpm)
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+            if self.token_budget < tokens:
+                wait_time = max(wait_time, (tokens - self.token_budget) * 60 / self.tpm)
+        return wait_time
+
+    def acquire(self, tokens=0):
+        with self.condition:
+            while True:
+                self._refill()
+                wait_time = self._wait_time(tokens)
+                if not wait_time:
+                    break
+                self.condition.wait(wait_time)
+            self.in_flight += 1
+            if self.rpm:
+                self.request_budget -= 1
+            if self.tpm:
+                self.token_budget -= min(tokens, self.tpm)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.limit = min(self.limit + 1 / max(self.limit, 1), self.max_concurrency)
+
+    def on_throttle(self):
+        with self.condition:
+            self.limit = max(self.limit / 2, 1)
+
+    def classify_error(self, err):
+        # returns (is_retryable, is_throttle, retry_after)
+        status_code = getattr(err, "status_code", None)
+        response = getattr(err, "response", None)
+        if status_code==None and response!=None and not isinstance(response, dict):
+            status_code = getattr(response, "status_code", None)
+        retry_after = getattr(err, "retry_after", None)
+        if retry_after==None and response!=None and hasattr(response, "headers"):
+            retry_after = GptQueryError.parse_retry_after(response.headers.get("Retry-After"))
+        if isinstance(response, dict):
+            # botocore ClientError
+            if response.get("Error", {}).get("Code") in self.THROTTLE_ERROR_CODES:
+                return True, True, retry_after
+            status_code = response.get("ResponseMetadata", {}).get("HTTPStatusCode", status_code)
+
+        if status_code in self.THROTTLE_STATUS_CODES:
+            return True, True, retry_after
+        if status_code in self.RETRYABLE_STATUS_CODES:
+            return True, False, retry_after
+        if isinstance(err, (asyncio.TimeoutError, ConnectionError, TimeoutError)):
+            return True, True, retry_after
+        requests = sys.modules.get("requests")
+        if requests and isinstance(err, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+            # requests is loaded only if its backend is used
+            return True, True, retry_after
+        return status_code==None, False, retry_after
+
+    def get_backoff(self, retry_count, retry_after=None):
+        if retry_after!=None:
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry_count)))
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
 
 
 class GptQueryWithCheck:
-    def __init__(self, client=None, promptfile=None):
+    def __init__(self, client=None, promptfile=None, rate_controller=None):
         self.client = client
+        self.rate_controller = rate_controller if rate_controller else RateController()
         self.system_prompt = None
         self.user_prompt = None
         if promptfile:
@@ -301,15 +715,37 @@ class GptQueryWithCheck:
 
         return system_prompt, user_prompt
 
-    def _query(self, system_prompt, user_prompt):
-        content = None
-        response = None
+    def create_stop_condition(self, replace_keydata={}):
+        # override this to cancel the streamed response early e.g. StreamStopCondition(code_blocks=1)
+        return None
 
+    def _query(self, system_prompt, user_prompt, stop_condition=None):
+        # raises the client's exception to let query() back off
         if self.client and user_prompt:
+            controller = self.rate_controller
+            controller.acquire( controller.estimate_tokens(system_prompt, user_prompt) )
             try:
-                content, response = self.client.query(system_prompt, user_prompt)
-            except:
-                pass
+                if stop_condition:
+                    content, response = self.client.query(system_prompt, user_prompt, stop_condition)
+                else:
+                    content, response = self.client.query(system_prompt, user_prompt)
+            finally:
+                controller.release()
+            controller.on_success()
+            return content, response
+
+        return None, None
+
+    async def _query_async(self, system_prompt, user_prompt, stop_condition=None):
+        if self.client and user_prompt:
+            controller = self.rate_controller
+            # the controller blocks the thread until the budgets allow the request
+            await asyncio.to_thread(controller.acquire, controller.estimate_tokens(system_prompt, user_prompt))
+            try:
+                content, response = await self.client.query_async(system_prompt, user_prompt, stop_condition)
+            finally:
+                controller.release()
+            controller.on_success()
             return content, response
 
         return None, None
@@ -320,6 +756,10 @@ class GptQueryWithCheck:
             return False
         return True
 
+    def check_query_result(self, query_result, replace_keydata={}):
+        # override this if the check needs the query's input
+        return self.is_ok_query_result(query_result)
+
     def query(self, replace_keydata={}):
         content = None
         response = None
@@ -328,15 +768,67 @@ class GptQueryWithCheck:
         #print(system_prompt)
         #print(user_prompt)
 
+        controller = self.rate_controller
         retry_count = 0
-        while retry_count<3:
+        while retry_count<controller.max_retries:
             # 1st level
-            content, response = self._query(system_prompt, user_prompt)
             retry_count += 1
-            if self.is_ok_query_result(content):
+            try:
+                content, response = self._query(system_prompt, user_prompt, self.create_stop_condition(replace_keydata))
+            except Exception as err:
+                content = response = None
+                backoff = self.get_retry_backoff(err, retry_count)
+                if backoff==None:
+                    break
+                controller.sleep(backoff)
+                continue
+            if self.check_query_result(content, replace_keydata):
+                break
+            else:
+                print(f"ERROR!!!: LLM didn't expected anser. Retry:{retry_count}")
+                print(content)
+
+        return content, response
+
+    async def query_async(self, replace_keydata={}):
+        # same retry & rate control as query() on the event loop. call close_async() when the queries on the loop are done
+        content = None
+        response = None
+
+        system_prompt, user_prompt = self._generate_prompt(replace_keydata)
+
+        controller = self.rate_controller
+        retry_count = 0
+        while retry_count<controller.max_retries:
+            retry_count += 1
+            try:
+                content, response = await self._query_async(system_prompt, user_prompt, self.create_stop_condition(replace_keydata))
+            except Exception as err:
+                content = response = None
+                backoff = self.get_retry_backoff(err, retry_count)
+                if backoff==None:
+                    break
+                await asyncio.sleep(backoff)
+                continue
+            if self.check_query_result(content, replace_keydata):
                 break
             else:
                 print(f"ERROR!!!: LLM didn't expected anser. Retry:{retry_count}")
                 print(content)
 
         return content, response
+
+    async def close_async(self):
+        if self.client:
+            await self.client.close_async()
+
+    def get_retry_backoff(self, err, retry_count):
+        # seconds to wait before the next retry of the failed query. None if it shouldn't be retried
+        controller = self.rate_controller
+        is_retryable, is_throttle, retry_after = controller.classify_error(err)
+        if is_throttle:
+            controller.on_throttle()
+        print(f"ERROR!!!: LLM query failed ({err}). Retry:{retry_count}")
+        if not is_retryable:
+            return None
+        return controller.get_backoff(retry_count, retry_after) if retry_count<controller.max_retries else 0
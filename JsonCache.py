@@ -16,9 +16,279 @@ import json
 import os
 import sys
 import re
-from datetime import timedelta, datetime
+from datetime import datetime
 import glob
 import time
+import threading
+import sqlite3
+from collections import OrderedDict
+
+
+class JsonCacheFileStorage:
+  # one json file per entry (original layout)
+  def __init__(self, cacheDir):
+    self.cacheBaseDir = cacheDir
+    self.lock = threading.Lock()
+
+  def ensureCacheStorage(self):
+    if not os.path.exists(self.cacheBaseDir):
+      os.makedirs(self.cacheBaseDir, exist_ok=True)
+
+  def getPath(self, key):
+    if JsonCache.isHashedKey(key):
+      # content-addressed keys are sharded into 2 level directories e.g. ab/cd/abcd....json
+      return os.path.join(self.cacheBaseDir, key[0:2], key[2:4], key + ".json")
+    return os.path.join(self.cacheBaseDir, key + ".json")
+
+  def get(self, key):
+    result = None
+    cachePath = self.getPath(key)
+    if os.path.exists( cachePath ):
+      try:
+        with open(cachePath, 'r', encoding='UTF-8') as f:
+          result = json.load(f)
+          f.close()
+      except:
+        pass
+    return result
+
+  def put(self, key, value):
+    cachePath = self.getPath(key)
+    os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+    # write to a temporary file and rename it so that concurrent readers never see a partial file
+    tmpPath = f'{cachePath}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmpPath, 'w', encoding='UTF-8') as f:
+      json.dump(value, f, indent = 4, ensure_ascii=False)
+      size = f.tell()
+      f.close()
+    with self.lock:
+      os.replace(tmpPath, cachePath)
+    return size
+
+  def putMany(self, items):
+    for key, value in items:
+      self.put(key, value)
+
+  def remove(self, key):
+    try:
+      os.remove(self.getPath(key))
+    except:
+      pass
+
+  def listEntries(self, path = None, depth = 0):
+    # (key, size, lastUpdate) of each entry. lastUpdate is the file's mtime as epoch
+    result = []
+    path = path if path else self.cacheBaseDir
+    if os.path.isdir(path):
+      with os.scandir(path) as it:
+        for entry in it:
+          if entry.name.endswith(".json") and entry.is_file():
+            stat = entry.stat()
+            result.append( (entry.name[:-len(".json")], stat.st_size, stat.st_mtime) )
+          elif depth<2 and len(entry.name)==2 and entry.is_dir():
+            result.extend( self.listEntries(entry.path, depth+1) )
+    return result
+
+  def clear(self):
+    for key, _, _ in self.listEntries():
+      self.remove(key)
+    self.pruneEmptyDirs()
+
+  def pruneEmptyDirs(self):
+    # remove the empty shard directories e.g. ab/cd/ left by the removed entries
+    for shardDir in glob.glob(os.path.join(self.cacheBaseDir, "??", "??")) + glob.glob(os.path.join(self.cacheBaseDir, "??")):
+      try:
+        os.rmdir(shardDir)
+      except OSError:
+        pass
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+
+class JsonCacheSqliteStorage:
+  # all entries in a single sqlite database (WAL mode : concurrent readers with a single writer)
+  DB_FILENAME = "cache.sqlite3"
+  DEFAULT_BATCH_SIZE = 64
+
+  def __init__(self, cacheDir, batchSize = None):
+    self.cacheBaseDir = cacheDir
+    self.dbPath = os.path.join(cacheDir, self.DB_FILENAME)
+    self.batchSize = batchSize if batchSize else self.DEFAULT_BATCH_SIZE
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.local = threading.local()
+    self.connections = []
+    if not os.path.exists(self.cacheBaseDir):
+      os.makedirs(self.cacheBaseDir, exist_ok=True)
+    conn = self.getConnection()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, last_update TEXT, data TEXT)")
+    conn.commit()
+
+  def getConnection(self):
+    # sqlite3 connection can't be shared between threads, then open one per thread
+    conn = getattr(self.local, "conn", None)
+    if conn is None:
+      conn = sqlite3.connect(self.dbPath, timeout=30, check_same_thread=False)
+      conn.execute("PRAGMA synchronous=NORMAL")
+      self.local.conn = conn
+      with self.lock:
+        self.connections.append(conn)
+    return conn
+
+  def get(self, key):
+    with self.lock:
+      row = self.pending.get(key)
+    if not row:
+      row = self.getConnection().execute("SELECT last_update, data FROM entries WHERE key=?", (key,)).fetchone()
+    if row:
+      return {"lastUpdate": row[0], "data": json.loads(row[1])}
+    return None
+
+  def put(self, key, value):
+    data = json.dumps(value["data"], ensure_ascii=False)
+    with self.lock:
+      self.pending[key] = (value["lastUpdate"], data)
+      isFlushNeeded = len(self.pending) >= self.batchSize
+    if isFlushNeeded:
+      self.flush()
+    return len(data)
+
+  def putMany(self, items):
+    with self.lock:
+      for key, value in items:
+        self.pending[key] = (value["lastUpdate"], json.dumps(value["data"], ensure_ascii=False))
+    self.flush()
+
+  def flush(self):
+    with self.lock:
+      pending = self.pending
+      self.pending = {}
+    if pending:
+      conn = self.getConnection()
+      with conn:
+        conn.executemany("INSERT OR REPLACE INTO entries (key, last_update, data) VALUES (?, ?, ?)",
+          [(key, row[0], row[1]) for key, row in pending.items()])
+
+  def remove(self, key):
+    with self.lock:
+      self.pending.pop(key, None)
+    conn = self.getConnection()
+    with conn:
+      conn.execute("DELETE FROM entries WHERE key=?", (key,))
+
+  def listEntries(self):
+    # (key, size, lastUpdate) of each entry
+    self.flush()
+    rows = self.getConnection().execute("SELECT key, length(data), last_update FROM entries").fetchall()
+    return [(key, size, JsonCache.parseLastUpdate(lastUpdate)) for key, size, lastUpdate in rows]
+
+  def clear(self):
+    with self.lock:
+      self.pending = {}
+    conn = self.getConnection()
+    with conn:
+      conn.execute("DELETE FROM entries")
+
+  def close(self):
+    self.flush()
+    with self.lock:
+      for conn in self.connections:
+        conn.close()
+      self.connections = []
+    self.local = threading.local()
+
+
+class JsonCacheMemoryStorage:
+  # write-through view of another storage which keeps the recently used entries in memory e.g. for the long running server
+  def __init__(self, storage, maxEntries):
+    self.storage = storage
+    self.maxEntries = maxEntries
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()
+
+  def keep(self, key, value):
+    with self.lock:
+      self.entries[key] = value
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxEntries:
+        self.entries.popitem(last=False)
+
+  def get(self, key):
+    with self.lock:
+      value = self.entries.get(key)
+      if value != None:
+        self.entries.move_to_end(key)
+        return value
+    # not kept or stored by another process
+    value = self.storage.get(key)
+    if value != None:
+      self.keep(key, value)
+    return value
+
+  def put(self, key, value):
+    size = self.storage.put(key, value)
+    self.keep(key, value)
+    return size
+
+  def putMany(self, items):
+    self.storage.putMany(items)
+    for key, value in items:
+      self.keep(key, value)
+
+  def remove(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+    self.storage.remove(key)
+
+  def listEntries(self):
+    return self.storage.listEntries()
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+    self.storage.clear()
+
+  def flush(self):
+    self.storage.flush()
+
+  def close(self):
+    self.storage.close()
+
+
+class JsonCacheIndex:
+  # in-memory index of key -> [size, lastUpdate as epoch] in LRU order (the least recently used first)
+  def __init__(self):
+    self.entries = OrderedDict()
+    self.totalBytes = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def put(self, key, size, lastUpdate):
+    self.remove(key)
+    self.entries[key] = [size, lastUpdate]
+    self.totalBytes += size
+
+  def touch(self, key):
+    entry = self.entries.get(key)
+    if entry:
+      self.entries.move_to_end(key)
+    return entry
+
+  def remove(self, key):
+    entry = self.entries.pop(key, None)
+    if entry:
+      self.totalBytes -= entry[0]
+
+  def popLeastRecentlyUsed(self):
+    key, entry = self.entries.popitem(last=False)
+    self.totalBytes -= entry[0]
+    return key
 
 
 class JsonCache:
@@ -26,16 +296,47 @@ class JsonCache:
   DEFAULT_CACHE_EXPIRE_HOURS = 1 # an hour
   CACHE_INFINITE = -1
 
-  def __init__(self, cacheDir = None, expireHour = None, numOfCache = None):
-  	self.cacheBaseDir = cacheDir if cacheDir else JsonCache.DEFAULT_CACHE_BASE_DIR
-  	self.expireHour = expireHour if expireHour else JsonCache.DEFAULT_CACHE_EXPIRE_HOURS
-  	self.numOfCache = numOfCache if numOfCache else JsonCache.CACHE_INFINITE
+  BACKEND_JSON = "json"
+  BACKEND_SQLITE = "sqlite"
+
+  HASHED_KEY_PATTERN = re.compile(r'[0-9a-f]{40}')
+
+  def __init__(self, cacheDir = None, expireHour = None, numOfCache = None, backend = None, maxCacheBytes = None, memoryCacheEntries = None):
+    self.cacheBaseDir = cacheDir if cacheDir else JsonCache.DEFAULT_CACHE_BASE_DIR
+    self.expireHour = expireHour if expireHour else JsonCache.DEFAULT_CACHE_EXPIRE_HOURS
+    self.numOfCache = numOfCache if numOfCache else JsonCache.CACHE_INFINITE
+    self.maxCacheBytes = maxCacheBytes if maxCacheBytes else JsonCache.CACHE_INFINITE
+    self.lock = threading.Lock()
+    self.index = None
+    self.storage = JsonCache.newStorage(backend, self.cacheBaseDir)
+    # the storage without JsonCacheMemoryStorage
+    self.backendStorage = self.storage
+    if isinstance(self.storage, JsonCacheSqliteStorage):
+      self.migrateFromJsonFiles()
+    if memoryCacheEntries:
+      self.storage = JsonCacheMemoryStorage(self.storage, memoryCacheEntries)
+
+  @staticmethod
+  def newStorage(backend, cacheDir):
+    if backend == JsonCache.BACKEND_SQLITE:
+      return JsonCacheSqliteStorage(cacheDir)
+    elif backend == None or backend == JsonCache.BACKEND_JSON:
+      return JsonCacheFileStorage(cacheDir)
+    # already instantiated storage
+    return backend
 
   def ensureCacheStorage(self):
     if not os.path.exists(self.cacheBaseDir):
-      os.makedirs(self.cacheBaseDir)
+      os.makedirs(self.cacheBaseDir, exist_ok=True)
 
-  def getCacheFilename(self, url):
+  @staticmethod
+  def isHashedKey(url):
+    return len(url)==40 and JsonCache.HASHED_KEY_PATTERN.fullmatch(url) != None
+
+  def getCacheKey(self, url):
+    if JsonCache.isHashedKey(url):
+      # already filename safe. no need to sanitize
+      return url
     result = url
     result = re.sub(r'^https?://', '', url)
     result = re.sub(r'^[a-zA-Z0-9\-_]+\.[a-zA-Z]{2,}', '', result)
@@ -47,66 +348,149 @@ class JsonCache:
     result = re.sub(r'#', '_', result)
     result = re.sub(r'\n', '_', result)
     result = re.sub('_+', '_', result)
-    result = result + ".json"
     return result
 
+  def getCacheFilename(self, url):
+    return self.getCacheKey(url) + ".json"
+
   def getCachePath(self, url):
     return os.path.join(self.cacheBaseDir, self.getCacheFilename(url))
 
+  @staticmethod
+  def parseLastUpdate(lastUpdateString):
+    # fast path of datetime.strptime(lastUpdateString, "%Y-%m-%d %H:%M:%S").timestamp()
+    s = lastUpdateString
+    return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19])).timestamp()
+
+  def isIndexRequired(self):
+    return self.numOfCache!=self.CACHE_INFINITE or self.maxCacheBytes!=self.CACHE_INFINITE or self.expireHour!=self.CACHE_INFINITE
+
+  def ensureIndex(self):
+    # build the index once from the storage. expired entries are dropped here. should be called with self.lock
+    if self.index == None:
+      index = JsonCacheIndex()
+      for key, size, lastUpdate in sorted(self.storage.listEntries(), key=lambda x: x[2]):
+        if self.isValidCache(lastUpdate):
+          index.put(key, size, lastUpdate)
+        else:
+          self.storage.remove(key)
+      self.index = index
+      self.evict()
+    return self.index
+
+  def evict(self):
+    # remove the least recently used entries until both of the count and the bytes bounds are satisfied. should be called with self.lock
+    index = self.ensureIndex()
+    while len(index) and ( (self.numOfCache!=self.CACHE_INFINITE and len(index)>self.numOfCache) or (self.maxCacheBytes!=self.CACHE_INFINITE and index.totalBytes>self.maxCacheBytes) ):
+      self.storage.remove( index.popLeastRecentlyUsed() )
+
   def limitNumOfCacheFiles(self):
-  	if self.numOfCache!=self.CACHE_INFINITE:
-	  	files = glob.glob(f'{self.cacheBaseDir}/*.json')
-	  	files = sorted(files, key=os.path.getmtime, reverse=True)
-	  	remove_files = files[self.numOfCache:]
-	  	for aRemoveFile in remove_files:
-	  		try:
-		  		os.remove(aRemoveFile)
-		  	except:
-		  		pass
+    if self.numOfCache!=self.CACHE_INFINITE or self.maxCacheBytes!=self.CACHE_INFINITE:
+      with self.lock:
+        self.evict()
 
 
   def storeToCache(self, url, result):
-    self.ensureCacheStorage()
-    cachePath = self.getCachePath( url )
     dt_now = datetime.now()
     _result = {
-    	"lastUpdate":dt_now.strftime("%Y-%m-%d %H:%M:%S"),
-    	"data": result
+      "lastUpdate":dt_now.strftime("%Y-%m-%d %H:%M:%S"),
+      "data": result
     }
-    with open(cachePath, 'w', encoding='UTF-8') as f:
-      json.dump(_result, f, indent = 4, ensure_ascii=False)
-      f.close()
-    self.limitNumOfCacheFiles()
+    key = self.getCacheKey(url)
+    size = self.storage.put(key, _result)
+    if self.isIndexRequired():
+      with self.lock:
+        self.ensureIndex().put(key, size, dt_now.timestamp())
+        self.evict()
 
 
-  def isValidCache(self, lastUpdateString):
-    result = False
-    lastUpdate = datetime.strptime(lastUpdateString, "%Y-%m-%d %H:%M:%S")
+  def storeManyToCache(self, items):
+    # bulk version of storeToCache. items : [(url, result)]
     dt_now = datetime.now()
-    if self.expireHour == self.CACHE_INFINITE or ( dt_now < ( lastUpdate+timedelta(hours=self.expireHour) ) ):
-      result = True
+    lastUpdate = dt_now.strftime("%Y-%m-%d %H:%M:%S")
+    entries = [(self.getCacheKey(url), {"lastUpdate": lastUpdate, "data": result}) for url, result in items]
+    self.storage.putMany(entries)
+    if self.isIndexRequired():
+      with self.lock:
+        index = self.ensureIndex()
+        for key, entry in entries:
+          index.put(key, len(json.dumps(entry["data"], ensure_ascii=False)), dt_now.timestamp())
+        self.evict()
 
-    return result
+  def isValidCache(self, lastUpdate):
+    # lastUpdate is epoch or "%Y-%m-%d %H:%M:%S" string
+    if self.expireHour == self.CACHE_INFINITE:
+      return True
+    if isinstance(lastUpdate, str):
+      lastUpdate = JsonCache.parseLastUpdate(lastUpdate)
+    return time.time() < lastUpdate + self.expireHour * 3600
 
   def restoreFromCache(self, url):
     result = None
-    cachePath = self.getCachePath( url )
-    if os.path.exists( cachePath ):
-	    with open(cachePath, 'r', encoding='UTF-8') as f:
-	      _result = json.load(f)
-	      f.close()
+    entry = None
+    key = self.getCacheKey(url)
+    if self.isIndexRequired():
+      with self.lock:
+        entry = self.ensureIndex().touch(key)
+      if entry and not self.isValidCache(entry[1]):
+        with self.lock:
+          self.index.remove(key)
+        self.storage.remove(key)
+        return None
 
-	    if "lastUpdate" in _result:
-	      if self.isValidCache( _result["lastUpdate"] ):
-	        result = _result["data"]
+    _result = self.storage.get( key )
+    if _result and "lastUpdate" in _result:
+      if entry:
+        result = _result["data"]
+      elif self.isValidCache( _result["lastUpdate"] ):
+        # not in the index e.g. stored by another process
+        result = _result["data"]
+        if self.isIndexRequired():
+          with self.lock:
+            self.index.put(key, len(json.dumps(result, ensure_ascii=False)), JsonCache.parseLastUpdate(_result["lastUpdate"]))
+            self.evict()
 
     return result
 
+  def migrateFromJsonFiles(self, cacheDir = None):
+    # one-shot migration from the one-json-file-per-entry layout. migrated files are removed.
+    fileStorage = JsonCacheFileStorage(cacheDir if cacheDir else self.cacheBaseDir)
+    items = []
+    for key, _, _ in fileStorage.listEntries():
+      _result = fileStorage.get(key)
+      if _result and "lastUpdate" in _result and "data" in _result:
+        items.append( (key, _result) )
+    if items:
+      self.storage.putMany(items)
+      for key, _ in items:
+        fileStorage.remove(key)
+      fileStorage.pruneEmptyDirs()
+    return len(items)
+
+  def flush(self):
+    self.storage.flush()
+
+  def close(self):
+    self.storage.close()
+
+  def clear(self):
+    with self.lock:
+      self.storage.clear()
+      self.index = None
+    # the entries stored with the other backend before switching the backend
+    if not isinstance(self.backendStorage, JsonCacheFileStorage):
+      JsonCacheFileStorage(self.cacheBaseDir).clear()
+    if not isinstance(self.backendStorage, JsonCacheSqliteStorage) and os.path.exists(os.path.join(self.cacheBaseDir, JsonCacheSqliteStorage.DB_FILENAME)):
+      storage = JsonCacheSqliteStorage(self.cacheBaseDir)
+      storage.clear()
+      storage.close()
+
   @staticmethod
   def clearAllCache(cacheId):
-  	files = glob.glob(f'{os.path.join(JsonCache.DEFAULT_CACHE_BASE_DIR, cacheId)}/*.json')
-  	for aRemoveFile in files:
-  		try:
-  			os.remove(aRemoveFile)
-  		except:
-  			pass
+    cacheDir = os.path.join(JsonCache.DEFAULT_CACHE_BASE_DIR, cacheId)
+    JsonCacheFileStorage(cacheDir).clear()
+    for aRemoveFile in glob.glob(f'{cacheDir}/{JsonCacheSqliteStorage.DB_FILENAME}*'):
+      try:
+        os.remove(aRemoveFile)
+      except:
+        pass
@@ -0,0 +1,113 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import json
+import threading
+
+class OfflineBatchWriter:
+    # writes the prompts as OpenAI batch style jsonl instead of querying them.
+    # the manifest maps each custom_id to the findings which wait for its result
+    DEFAULT_URL = "/v1/chat/completions"
+
+    def __init__(self, prompts_path, model=None, url=None):
+        self.prompts_path = prompts_path
+        self.manifest_path = OfflineBatchWriter.get_manifest_path(prompts_path)
+        self.model = model
+        self.url = url if url else self.DEFAULT_URL
+        self.lock = threading.Lock()
+        self.custom_ids = set()
+        self.num_of_findings = 0
+        dir_path = os.path.dirname(os.path.abspath(prompts_path))
+        os.makedirs(dir_path, exist_ok=True)
+        self.prompts = open(prompts_path, 'w', encoding='UTF-8')
+        self.manifest = open(self.manifest_path, 'w', encoding='UTF-8')
+
+    @staticmethod
+    def get_manifest_path(prompts_path):
+        return prompts_path + ".manifest.jsonl"
+
+    def create_body(self, system_prompt, user_prompt, stop_condition=None):
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": user_prompt})
+        body = {"messages": messages}
+        if self.model:
+            body["model"] = self.model
+        if stop_condition:
+            if stop_condition.stop_sequences:
+                body["stop"] = stop_condition.stop_sequences
+            if stop_condition.max_output_tokens:
+                body["max_tokens"] = stop_condition.max_output_tokens
+        return body
+
+    def add(self, custom_id, system_prompt, user_prompt, stop_condition, finding):
+        # the same custom_id (the identical query) is written once and the finding is added to the manifest
+        with self.lock:
+            if not custom_id in self.custom_ids:
+                self.custom_ids.add(custom_id)
+                request = {"custom_id": custom_id, "method": "POST", "url": self.url, "body": self.create_body(system_prompt, user_prompt, stop_condition)}
+                self.prompts.write(json.dumps(request, ensure_ascii=False) + "\n")
+            finding = dict(finding)
+            finding["custom_id"] = custom_id
+            self.manifest.write(json.dumps(finding, ensure_ascii=False) + "\n")
+            self.num_of_findings += 1
+
+    def close(self):
+        with self.lock:
+            self.prompts.close()
+            self.manifest.close()
+
+
+class OfflineBatchReader:
+    # reads the batch results jsonl and the manifest written by OfflineBatchWriter
+    @staticmethod
+    def read_manifest(manifest_path):
+        # returns {custom_id: [finding]}
+        result = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='UTF-8') as f:
+                for line in f:
+                    try:
+                        finding = json.loads(line)
+                        result.setdefault(finding["custom_id"], []).append(finding)
+                    except:
+                        pass
+        return result
+
+    @staticmethod
+    def get_content(result):
+        # the content of {"custom_id":..., "response": {"status_code": 200, "body": {"choices": [{"message": {"content": ...}}]}}, "error": ...}
+        response = result.get("response")
+        if result.get("error") or not response or response.get("status_code", 200)!=200:
+            return None
+        body = response.get("body", {})
+        try:
+            return body["choices"][0]["message"]["content"]
+        except:
+            return None
+
+    @staticmethod
+    def iter_results(results_path):
+        # yields (custom_id, content). content is None if the request failed
+        if os.path.exists(results_path):
+            with open(results_path, 'r', encoding='UTF-8') as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except:
+                        continue
+                    if "custom_id" in result:
+                        yield result["custom_id"], OfflineBatchReader.get_content(result)
@@ -0,0 +1,197 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import json
+import socket
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class SharedOutput:
+    # output of a target shared by the identical in-flight requests. the request joined later reads the text written so far first
+    def __init__(self):
+        self.chunks = []
+        self.is_closed = False
+        self.summary = None
+        self.error = None
+        self.condition = threading.Condition()
+
+    def write(self, text):
+        with self.condition:
+            self.chunks.append(text)
+            self.condition.notify_all()
+
+    def flush(self):
+        pass
+
+    def close(self, summary=None, error=None):
+        with self.condition:
+            self.summary = summary
+            self.error = error
+            self.is_closed = True
+            self.condition.notify_all()
+
+    def iter_texts(self):
+        # yields the text written since the last one until the output is closed
+        pos = 0
+        while True:
+            with self.condition:
+                while pos>=len(self.chunks) and not self.is_closed:
+                    self.condition.wait()
+                chunks = self.chunks[pos:]
+                pos = len(self.chunks)
+                is_closed = self.is_closed
+            if chunks:
+                yield "".join(chunks)
+            if is_closed and pos>=len(self.chunks):
+                break
+
+
+class ResolverRequestHandler(socketserver.StreamRequestHandler):
+    # request : a json line {"targets": [...], "onlynew": bool, "fullcode": bool}
+    # response : json lines of {"type": "output"|"summary"|"error", "target": ..., "text": ...} and {"type": "done"} at last
+    def send(self, record):
+        self.wfile.write( (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8") )
+        self.wfile.flush()
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line.strip():
+            # e.g. the check of the running server
+            return
+        try:
+            try:
+                request = json.loads(line)
+                targets = request.get("targets", [])
+            except Exception as e:
+                self.send({"type": "error", "text": f"invalid request ({e})"})
+                return
+            server = self.server.resolver_server
+            outputs = [server.get_output(target_path, request.get("onlynew", False), request.get("fullcode", False)) for target_path in targets]
+            for target_path, output in zip(targets, outputs):
+                for text in output.iter_texts():
+                    self.send({"type": "output", "target": target_path, "text": text})
+                if output.error:
+                    self.send({"type": "error", "target": target_path, "text": output.error})
+                else:
+                    self.send({"type": "summary", "target": target_path, "text": output.summary})
+            self.send({"type": "done"})
+        except (BrokenPipeError, ConnectionResetError):
+            # the client has gone. the shared outputs are completed for the others
+            pass
+
+
+class ResolverServer:
+    # long running resolver on the unix domain socket. the LLM clients, the connection pools and the cache stay warm across the requests.
+    # process(target_path, is_only_new, is_full_code, out) writes the resolutions of the target to out and returns the summary text
+    def __init__(self, socket_path, process, max_workers=1):
+        self.socket_path = socket_path
+        self.process = process
+        self.executor = ThreadPoolExecutor(max_workers=max(max_workers, 1))
+        # (target_path, is_only_new, is_full_code) -> SharedOutput of the in-flight target
+        self.outputs = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def get_output(self, target_path, is_only_new, is_full_code):
+        # the identical target already in flight (e.g. from another job) is shared instead of being resolved again
+        key = (target_path, is_only_new, is_full_code)
+        with self.lock:
+            output = self.outputs.get(key)
+            if output!=None:
+                return output
+            output = SharedOutput()
+            self.outputs[key] = output
+        self.executor.submit(self.execute, key, output)
+        return output
+
+    def execute(self, key, output):
+        target_path, is_only_new, is_full_code = key
+        summary = error = None
+        try:
+            summary = self.process(target_path, is_only_new, is_full_code, output)
+        except Exception as e:
+            error = f"{target_path} : {e}"
+            print(f"ERROR!!!: {error}", file=sys.stderr)
+        finally:
+            with self.lock:
+                del self.outputs[key]
+            output.close(summary, error)
+
+    def remove_stale_socket(self):
+        if os.path.exists(self.socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(self.socket_path)
+                    raise OSError(f"{self.socket_path} is used by the running server")
+                except (ConnectionRefusedError, FileNotFoundError):
+                    pass
+            os.remove(self.socket_path)
+
+    def serve_forever(self):
+        self.remove_stale_socket()
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, ResolverRequestHandler)
+        self.server.daemon_threads = True
+        self.server.resolver_server = self
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+            self.executor.shutdown()
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+
+
+class ResolverClient:
+    # submits the targets to ResolverServer and writes the streamed resolutions to out as soon as they arrive
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+    def execute(self, target_paths, is_only_new=False, is_full_code=False, out=None, err=None):
+        # returns the number of the failed targets
+        out = out if out else sys.stdout
+        err = err if err else sys.stderr
+        num_of_errors = 0
+        num_of_done = 0
+        total = len(target_paths)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            request = {"targets": target_paths, "onlynew": is_only_new, "fullcode": is_full_code}
+            sock.sendall( (json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8") )
+            with sock.makefile('r', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    record_type = record.get("type")
+                    if record_type=="output":
+                        out.write(record["text"])
+                        out.flush()
+                    elif record_type=="summary":
+                        num_of_done += 1
+                        print(f"[{num_of_done}/{total}] {record['text']}", file=err)
+                    elif record_type=="error":
+                        num_of_done += 1
+                        num_of_errors += 1
+                        print(f"ERROR!!!: {record['text']}", file=err)
+                    elif record_type=="done":
+                        return num_of_errors
+        print("ERROR!!!: the connection to the resolver server was closed", file=err)
+        return num_of_errors + total - num_of_done
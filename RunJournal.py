@@ -0,0 +1,146 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import json
+import threading
+from FindingStore import FindingStore
+
+class RunJournal:
+    # append only jsonl of the run : the expanded targets, the parsed findings per target and the output of the completed targets
+    def __init__(self, path, is_resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.targets = None
+        self.findings = {}
+        self.parsed = {}
+        self.outputs = {}
+        # the resume without the previous journal starts a fresh one
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if is_resume:
+            self.load()
+        else:
+            with open(path, 'w', encoding='UTF-8') as f:
+                pass
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='UTF-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except:
+                        # the last line may be broken if the previous run was killed while writing it
+                        continue
+                    record_type = record.get("type")
+                    if record_type=="targets":
+                        self.targets = record["targets"]
+                    elif record_type=="parsing":
+                        # the target is parsed again from scratch. the file records of the previous attempt are dropped
+                        self.findings.pop(record["target"], None)
+                    elif record_type=="file":
+                        store = self.findings.setdefault(record["target"], FindingStore())
+                        for line_number, messages in record["reports"].items():
+                            for message_id, _messages in messages.items():
+                                for message in _messages:
+                                    store.add(record["filename"], int(line_number), message_id, message)
+                    elif record_type=="parsed":
+                        self.parsed[record["target"]] = record["base_path"]
+                    elif record_type=="done":
+                        self.outputs[record["target"]] = record["output"]
+        # the findings of the partially parsed target are incomplete
+        for target in list(self.findings.keys()):
+            if not target in self.parsed:
+                del self.findings[target]
+
+    def write(self, record):
+        with self.lock:
+            with open(self.path, 'a', encoding='UTF-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+
+    def get_targets(self):
+        return self.targets
+
+    def put_targets(self, targets):
+        self.targets = targets
+        self.write({"type": "targets", "targets": targets})
+
+    def is_parsed(self, target):
+        return target in self.parsed
+
+    def get_findings(self, target):
+        # (base_path, iterable of (filename, reports)) of the parsed target
+        return self.parsed[target], self.findings.get(target, FindingStore()).items()
+
+    def put_parsing(self, target):
+        self.write({"type": "parsing", "target": target})
+
+    def put_file_findings(self, target, filename, reports):
+        self.write({"type": "file", "target": target, "filename": filename, "reports": dict(reports.items())})
+
+    def put_parsed(self, target, base_path):
+        with self.lock:
+            self.parsed[target] = base_path
+        self.write({"type": "parsed", "target": target, "base_path": base_path})
+
+    def is_done(self, target):
+        return target in self.outputs
+
+    def get_output(self, target):
+        return self.outputs.get(target, "")
+
+    def put_done(self, target, output):
+        with self.lock:
+            self.outputs[target] = output
+        self.write({"type": "done", "target": target, "output": output})
+
+
+class JournaledTargetReader:
+    # records the findings of each target to the journal. the parsed target is restored from the journal without any analysis
+    def __init__(self, target_reader, journal):
+        self.target_reader = target_reader
+        self.journal = journal
+
+    def read(self, target_path):
+        if self.journal.is_parsed(target_path):
+            return self.journal.get_findings(target_path)
+        base_path, results = self.target_reader.read(target_path)
+        return base_path, self.record(target_path, base_path, results)
+
+    def record(self, target_path, base_path, results):
+        self.journal.put_parsing(target_path)
+        for filename, reports in results:
+            self.journal.put_file_findings(target_path, filename, reports)
+            yield filename, reports
+        self.journal.put_parsed(target_path, base_path)
+
+
+class JournalOutput:
+    # writes to out and keeps the text written since the last take()
+    def __init__(self, out):
+        self.out = out
+        self.buffer = []
+
+    def write(self, text):
+        self.buffer.append(text)
+        return self.out.write(text)
+
+    def flush(self):
+        self.out.flush()
+
+    def take(self):
+        text = "".join(self.buffer)
+        self.buffer = []
+        return text
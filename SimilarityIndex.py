@@ -0,0 +1,113 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import re
+import json
+import hashlib
+import threading
+
+class SimilarityIndex:
+    # SimHash of the snippets' tokens to find an already resolved snippet which is near-identical
+    # e.g. moved to the other file, shifted or reformatted. entries are persisted as jsonl in the cache dir
+    INDEX_FILENAME = "similarity_index.jsonl"
+    TOKEN = re.compile(r'\w+|[^\w\s]')
+    HASH_BITS = 64
+    NUM_OF_BANDS = 4
+    SHINGLE_SIZE = 3
+    DEFAULT_MAX_DISTANCE = 3
+    DEFAULT_MIN_TOKENS = 16
+
+    def __init__(self, cache_dir, max_distance=None, min_tokens=None):
+        self.path = os.path.join(cache_dir, self.INDEX_FILENAME)
+        self.max_distance = max_distance if max_distance!=None else self.DEFAULT_MAX_DISTANCE
+        self.min_tokens = min_tokens if min_tokens!=None else self.DEFAULT_MIN_TOKENS
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.buckets = {}
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='UTF-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.add_entry(entry["kind"], entry["simhash"], entry["uri"])
+                    except:
+                        pass
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.buckets = {}
+            try:
+                os.remove(self.path)
+            except:
+                pass
+
+    def get_tokens(self, text):
+        return self.TOKEN.findall(text)
+
+    def get_simhash(self, tokens):
+        vector = [0] * self.HASH_BITS
+        for i in range(max(len(tokens)-self.SHINGLE_SIZE+1, 1)):
+            shingle = " ".join(tokens[i:i+self.SHINGLE_SIZE])
+            h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+            for bit in range(self.HASH_BITS):
+                vector[bit] += 1 if h & (1<<bit) else -1
+        simhash = 0
+        for bit in range(self.HASH_BITS):
+            if vector[bit]>0:
+                simhash |= 1<<bit
+        return simhash
+
+    def get_bands(self, simhash):
+        # near-identical hashes (distance < NUM_OF_BANDS) share one band at least
+        band_bits = self.HASH_BITS // self.NUM_OF_BANDS
+        mask = (1<<band_bits)-1
+        return [(i, (simhash>>(i*band_bits)) & mask) for i in range(self.NUM_OF_BANDS)]
+
+    def add_entry(self, kind, simhash, uri):
+        if uri in self.entries:
+            return False
+        self.entries[uri] = (kind, simhash)
+        for band in self.get_bands(simhash):
+            self.buckets.setdefault( (kind, band), []).append(uri)
+        return True
+
+    def put(self, kind, text, uri):
+        # kind : the snippets are compared only in the same kind e.g. the same message id and prompt
+        tokens = self.get_tokens(text)
+        if len(tokens)<self.min_tokens:
+            return
+        simhash = self.get_simhash(tokens)
+        with self.lock:
+            if self.add_entry(kind, simhash, uri):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, 'a', encoding='UTF-8') as f:
+                    f.write(json.dumps({"kind": kind, "simhash": simhash, "uri": uri}) + "\n")
+
+    def find(self, kind, text):
+        # returns [(distance, uri)] of the candidates sorted by the distance. the ones over max_distance are included for the logging
+        tokens = self.get_tokens(text)
+        if len(tokens)<self.min_tokens:
+            return []
+        simhash = self.get_simhash(tokens)
+        candidates = set()
+        with self.lock:
+            for band in self.get_bands(simhash):
+                candidates.update( self.buckets.get( (kind, band), []) )
+            result = [(bin(self.entries[uri][1] ^ simhash).count("1"), uri) for uri in candidates]
+        return sorted(result)
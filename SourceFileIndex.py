@@ -0,0 +1,154 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import mmap
+import threading
+from array import array
+from collections import OrderedDict
+
+class SourceFile:
+    # read only sequence of the lines of the file. lines[i] is the line i+1 of the file without the line break.
+    # the large file is memory mapped (the map holds a file descriptor) and the small one is read into bytes
+    MMAP_MIN_BYTES = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.data = b""
+        self.is_mapped = False
+        if self.size:
+            with open(path, 'rb') as f:
+                if self.size >= self.MMAP_MIN_BYTES:
+                    self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.is_mapped = True
+                else:
+                    self.data = f.read()
+        data_size = len(self.data)
+        self.offsets = self.build_offsets(self.data, data_size)
+        self.final_newline = data_size>0 and self.data[data_size-1:data_size]==b"\n"
+
+    @staticmethod
+    def build_offsets(data, size):
+        # offsets[i] is the start of the line i. the last one is the end of the file
+        offsets = array('Q', [0])
+        pos = data.find(b"\n")
+        while pos != -1:
+            offsets.append(pos+1)
+            pos = data.find(b"\n", pos+1)
+        if offsets[-1] != size:
+            offsets.append(size)
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def get_line(self, index):
+        line = self.data[self.offsets[index]:self.offsets[index+1]]
+        if line.endswith(b"\n"):
+            line = line[:-1]
+        if line.endswith(b"\r"):
+            line = line[:-1]
+        return line.decode("utf-8", errors="replace")
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.get_line(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("line index out of range")
+        return self.get_line(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_line(i)
+
+    def get_memory_size(self):
+        return self.size + self.offsets.itemsize * len(self.offsets)
+
+    def is_modified(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime!=self.mtime or stat.st_size!=self.size
+        except:
+            return True
+
+
+class SourceFileIndex:
+    # shared SourceFile per path. the least recently used files are dropped to keep the total under max_bytes
+    # and the memory mapped ones under MAX_MAPPED_FILES (each map holds a file descriptor).
+    # dropped files are unmapped when nobody refers them anymore
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+    MAX_MAPPED_FILES = 128
+    shared_index = None
+    shared_lock = threading.Lock()
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes if max_bytes else self.DEFAULT_MAX_BYTES
+        self.lock = threading.Lock()
+        self.files = OrderedDict()
+        self.total_bytes = 0
+        self.num_of_mapped = 0
+
+    @staticmethod
+    def get_shared():
+        with SourceFileIndex.shared_lock:
+            if SourceFileIndex.shared_index == None:
+                SourceFileIndex.shared_index = SourceFileIndex()
+            return SourceFileIndex.shared_index
+
+    def remove(self, path):
+        source_file = self.files.pop(path, None)
+        if source_file:
+            self.total_bytes -= source_file.get_memory_size()
+            if source_file.is_mapped:
+                self.num_of_mapped -= 1
+
+    def get_least_recently_mapped(self):
+        for path, source_file in self.files.items():
+            if source_file.is_mapped:
+                return path
+        return None
+
+    def get(self, path):
+        # returns SourceFile or None if the path isn't a file
+        path = os.path.abspath(path)
+        with self.lock:
+            source_file = self.files.get(path)
+            if source_file!=None and not source_file.is_modified():
+                self.files.move_to_end(path)
+                return source_file
+            self.remove(path)
+        if not os.path.isfile(path):
+            return None
+        source_file = SourceFile(path)
+        with self.lock:
+            self.remove(path)
+            self.files[path] = source_file
+            self.total_bytes += source_file.get_memory_size()
+            if source_file.is_mapped:
+                self.num_of_mapped += 1
+            while self.total_bytes > self.max_bytes and len(self.files) > 1:
+                self.remove( next(iter(self.files)) )
+            while self.num_of_mapped > self.MAX_MAPPED_FILES:
+                self.remove( self.get_least_recently_mapped() )
+        return source_file
+
+    def get_lines(self, path):
+        # the lines of the file or [] if it doesn't exist
+        source_file = self.get(path)
+        return source_file if source_file!=None else []
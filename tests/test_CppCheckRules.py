@@ -0,0 +1,56 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from CppCheckRules import CppCheckRules
+
+
+class TestUseInitializationList(unittest.TestCase):
+    MESSAGE = "Variable 'x' is assigned in constructor body. Consider performing initialization in initialization list."
+
+    def resolve(self, code, target_line):
+        registry = CppCheckRules.new_registry()
+        return registry.resolve(code, target_line, {"useInitializationList": [self.MESSAGE]})
+
+    def test_out_of_class_constructor(self):
+        code = "A::A(int v) {\n    x = v;\n}"
+        self.assertEqual(self.resolve(code, 2), "```\nA::A(int v) : x(v) {\n}\n```")
+
+    def test_existing_initialization_list(self):
+        code = "A::A(int v)\n    : y(0)\n{\n    x = v;\n}"
+        self.assertEqual(self.resolve(code, 4), "```\nA::A(int v)\n    : y(0), x(v)\n{\n}\n```")
+
+    def test_in_class_constructor(self):
+        code = "class A {\n    explicit A(int v) {\n        x = v;\n    }\n    int x;\n};"
+        self.assertEqual(self.resolve(code, 3), "```\nclass A {\n    explicit A(int v) : x(v) {\n    }\n    int x;\n};\n```")
+
+    def test_control_blocks(self):
+        for header in ["if (a) {", "for (int i = 0; i < n; i++) {", "while (a) {", "} else if (a) {", "switch (a) {"]:
+            code = f"A::A(int v, bool a) {{\n    {header}\n        x = v;\n    }}\n}}"
+            self.assertIsNone(self.resolve(code, 3), header)
+
+    def test_member_function(self):
+        self.assertIsNone(self.resolve("void A::f(int v) {\n    x = v;\n}", 2))
+
+    def test_macro_without_class(self):
+        self.assertIsNone(self.resolve("TEST(A, B) {\n    x = v;\n}", 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ExecUtil import ExecUtil
+from GitUtil import GitUtil
+
+
+@unittest.skipUnless(shutil.which("git"), "git is required")
+class TestGetChangedHunks(unittest.TestCase):
+    def setUp(self):
+        self.repo = tempfile.mkdtemp()
+        self.git("git init -q")
+        self.git("git config user.email test@example.com")
+        self.git("git config user.name test")
+        self.write("a.cpp", b"int a;\nint b;\nint c;\n")
+        self.git("git add a.cpp")
+        self.git("git commit -q -m base")
+
+    def tearDown(self):
+        shutil.rmtree(self.repo, ignore_errors=True)
+
+    def git(self, command):
+        self.assertTrue(ExecUtil.execCmd(command, self.repo))
+
+    def write(self, filename, data):
+        with open(os.path.join(self.repo, filename), "wb") as f:
+            f.write(data)
+
+    def test_non_utf8_hunk(self):
+        # latin-1 and shift_jis comments in the changed lines
+        self.write("a.cpp", b"int a;\nint b; // caf\xe9\nint c;\n// \x93\xfa\x96\x7b\x8c\xea\n")
+        self.assertEqual(GitUtil.get_changed_hunks(self.repo, "HEAD"), {"a.cpp": [(2, 2), (4, 4)]})
+
+    def test_deletion_only(self):
+        self.write("a.cpp", b"int a;\nint c;\n")
+        self.assertEqual(GitUtil.get_changed_hunks(self.repo, "HEAD"), {"a.cpp": [(1, 2)]})
+
+
+if __name__ == "__main__":
+    unittest.main()